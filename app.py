@@ -1,5 +1,5 @@
 import streamlit as st
-from process_data import new_excel, get_cached_min_max_dates
+from process_data import import_file, get_cached_min_max_dates, release_connection
 import hashlib
 import os
 
@@ -102,21 +102,24 @@ def main():
     
     uploaded_file = st.sidebar.file_uploader(
         txt,
-        type=['xlsx', 'xls'],
+        type=['xlsx', 'xls', 'csv', 'parquet'],
         help="⚠️ Les données du fichier écrasent celles déjà présentes pour les mêmes jours."
     )
     
     if uploaded_file is not None:
         with st.spinner("Import des données en cours..."):
-            if new_excel(uploaded_file):
+            if import_file(uploaded_file):
+                # Les caches dépendant des trains sont invalidés par l'import lui-même
                 st.sidebar.success("Données importées avec succès")
-                # Invalider le cache après import
-                st.cache_data.clear()
             else:
                 st.sidebar.error("Erreur lors de l'import")
     
     # Exécution de la page sélectionnée
-    selected_page.run()
+    try:
+        selected_page.run()
+    finally:
+        # Rendre au pool la connexion utilisée pendant cette exécution
+        release_connection()
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
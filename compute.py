@@ -1,251 +1,573 @@
+import numpy as np
 import pandas as pd
 import streamlit as st
-from process_data import get_cached_trains_data, get_cached_events
+import os
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from process_data import get_cached_trains_data, get_cached_events, get_cached_opening_stocks, get_stock_timeline_from_warehouse, get_sim_events, get_table_version, register_invalidation_callback, load_stock_timeline, save_stock_timeline, delete_stock_timeline
 
-# Cache pour les calculs lourds
-@st.cache_data(ttl=600)  # Cache pour 10 minutes
+# Chronologies réelles corrigées, conservées pour être mises à jour de façon incrémentale
+_stocks_store = {}
+_stocks_store_lock = threading.Lock()
+_stocks_store_generation = 0
+STOCKS_STORE_TTL = 600  # 10 minutes
+
+# Calcul parallèle par lieu pour la vue "tous les lieux"
+_process_pool = None
+_process_pool_lock = threading.Lock()
+PARALLEL_WORKERS = os.cpu_count() or 1
+PARALLEL_MIN_TRAINS = 20000  # En dessous, le calcul séquentiel est plus rapide
+
+# Moteur de calcul des chronologies réelles : "pandas" (en mémoire) ou "sql" (cumul calculé par la base)
+STOCK_ENGINE = "pandas"
+
+# Rééchantillonnage des chronologies pour l'affichage
+RESAMPLE_MAX_POINTS = 1500  # Nombre maximal d'intervalles affichés par série
+RESAMPLE_FREQUENCIES = ['15min', '1h', '3h', '6h', '12h', '1D', '7D']
+
+# Cache pour les calculs lourds, versionné par les tables dont dépend chaque résultat
 def get_cached_trains_data_for_compute(location=None):
-    """Version mise en cache de get_trains_data pour les calculs"""
+    """Données des trains pour les calculs (cache de get_cached_trains_data)"""
     return get_cached_trains_data(location)
 
-@st.cache_data(ttl=600)  # Cache pour 10 minutes
 def get_cached_events_for_compute(location=None):
-    """Version mise en cache de get_events pour les calculs"""
+    """Corrections pour les calculs (cache de get_cached_events)"""
     return get_cached_events(location)
 
-@st.cache_data(ttl=300)  # Cache pour 5 minutes
 def compute_stocks_cached(location=None, simulation:bool=False, sim_events:pd.DataFrame=None):
     """Version mise en cache de compute_stocks"""
+    return _compute_stocks_cached(location, simulation, sim_events, get_table_version('trains'))
+
+@st.cache_data(ttl=300)  # Cache pour 5 minutes
+def _compute_stocks_cached(location, simulation, sim_events, trains_version):
     return compute_stocks(location, simulation=simulation, sim_events=sim_events)
 
-def apply_corrections(location=None, simulation:bool=False, sim_events:pd.DataFrame=None):
-    """Applique les corrections aux stocks avec cache"""
+def compute_simulated_stocks_cached(location=None, sim_events:pd.DataFrame=None):
+    """Version mise en cache de compute_simulated_stocks"""
+    return _compute_simulated_stocks_cached(location, sim_events, get_table_version('trains'))
+
+@st.cache_data(ttl=300)  # Cache pour 5 minutes
+def _compute_simulated_stocks_cached(location, sim_events, trains_version):
+    return compute_simulated_stocks(location, sim_events)
+
+def compute_window_stocks_cached(location=None, start=None, end=None):
+    """Version mise en cache de compute_window_stocks"""
+    return _compute_window_stocks_cached(location, start, end, get_table_version('trains'), get_table_version('events'))
+
+@st.cache_data(ttl=300)  # Cache pour 5 minutes
+def _compute_window_stocks_cached(location, start, end, trains_version, events_version):
+    return compute_window_stocks(location, start, end)
+
+def evaluate_simulations_cached(simulation_ids:tuple, location=None):
+    """Version mise en cache de evaluate_simulations"""
+    versions = (
+        get_table_version('trains'),
+        get_table_version('events'),
+        tuple(get_table_version('sim_events', simulation_id) for simulation_id in simulation_ids),
+    )
+    return _evaluate_simulations_cached(tuple(simulation_ids), location, versions)
+
+@st.cache_data(ttl=300)  # Cache pour 5 minutes
+def _evaluate_simulations_cached(simulation_ids, location, versions):
+    return evaluate_simulations(list(simulation_ids), location)
+
+def apply_corrections(location=None, simulation:bool=False, sim_events:pd.DataFrame=None, delta:bool=False, start=None, end=None):
+    """Applique les corrections aux stocks avec cache
+
+    Avec delta=True, les stocks simulés sont obtenus à partir des stocks réels en cache
+    auxquels on ajoute uniquement l'effet des trains touchés par la simulation.
+    Avec start et end, la chronologie réelle peut se limiter à cette fenêtre (voir get_window_stocks).
+    """
+    if not simulation and start is not None and end is not None:
+        return get_window_stocks(location, start, end)
+
+    if not simulation:
+        # Chronologie réelle : conservée et mise à jour de façon incrémentale après une correction
+        return get_corrected_stocks(location)
+
     # Récupérer les événements de correction avec cache
     corrections = get_cached_events_for_compute(location)
-    wagons_count_df = compute_stocks_cached(location, simulation=simulation, sim_events=sim_events)
-    
+    if delta:
+        wagons_count_df = compute_simulated_stocks_cached(location, sim_events=sim_events)
+    else:
+        wagons_count_df = compute_stocks_cached(location, simulation=simulation, sim_events=sim_events)
+
+    return correct_stocks(wagons_count_df, corrections, location)
+
+def get_corrected_stocks(location=None):
+    """Retourne la chronologie réelle corrigée d'un lieu.
+
+    Le résultat est conservé en mémoire : après une modification de correction, seule la
+    fin de la chronologie du lieu concerné est recalculée (voir patch_corrected_stocks).
+    """
+    return _get_stocks_entry(location)['corrected'].copy()
+
+def get_window_stocks(location, start, end):
+    """Retourne la chronologie réelle corrigée d'un lieu couvrant au moins la fenêtre [start, end].
+
+    Si la chronologie complète est déjà en mémoire, elle est retournée telle quelle ; sinon
+    seule la fenêtre est lue et calculée (voir compute_window_stocks).
+    """
+    with _stocks_store_lock:
+        in_store = location in _stocks_store
+    if in_store:
+        return get_corrected_stocks(location)
+    return compute_window_stocks_cached(location, pd.Timestamp(start), pd.Timestamp(end)).copy()
+
+def _get_stocks_entry(location, materialized:bool=True):
+    """Retourne l'entrée conservée pour un lieu, après application des corrections en attente.
+
+    Une entrée absente est d'abord lue depuis la table matérialisée (si materialized=True),
+    puis calculée si la table ne contient pas encore la chronologie.
+    """
+    with _stocks_store_lock:
+        entry = _stocks_store.get(location)
+        if entry is not None and time.time() - entry['created_at'] >= STOCKS_STORE_TTL:
+            del _stocks_store[location]
+            entry = None
+        if entry is not None:
+            if entry['pending']:
+                if entry['base'] is None:
+                    # Chronologie lue depuis la table matérialisée : la chronologie brute n'est
+                    # calculée que lorsqu'une correction doit y être réappliquée
+                    entry['base'] = compute_stocks_cached(location)
+                corrections = get_cached_events_for_compute(location)
+                for patched_location, since in entry['pending']:
+                    entry['corrected'] = patch_corrected_stocks(entry['corrected'], entry['base'], corrections, location, patched_location, since)
+                entry['pending'] = []
+            return entry
+        generation = _stocks_store_generation
+
+    # Lecture ou calcul complet en dehors du verrou pour ne pas bloquer les autres sessions
+    wagons_count_df = None
+    corrected_df = load_stock_timeline(_materialized_scope(location), None if location == "AMB" else location) if materialized else pd.DataFrame()
+    if corrected_df.empty:
+        # Avec le moteur SQL, le cumul est calculé par la base : pas de calcul parallèle local
+        trains_data = get_cached_trains_data_for_compute(location) if STOCK_ENGINE != "sql" else pd.DataFrame()
+        if location is None and PARALLEL_WORKERS > 1 and len(trains_data) >= PARALLEL_MIN_TRAINS:
+            wagons_count_df, corrected_df = compute_corrected_stocks_parallel(trains_data, get_cached_events_for_compute(None))
+        else:
+            wagons_count_df = compute_stocks_cached(location)
+            corrected_df = correct_stocks(wagons_count_df, get_cached_events_for_compute(location), location)
+    entry = {
+        'base': wagons_count_df,
+        'corrected': corrected_df,
+        'pending': [],
+        'created_at': time.time(),
+    }
+
+    with _stocks_store_lock:
+        # Ne conserver le résultat que si aucune donnée n'a été modifiée pendant le calcul
+        is_current = generation == _stocks_store_generation
+        if is_current:
+            _stocks_store[location] = entry
+
+    # Premier calcul d'un périmètre matérialisé : l'enregistrer pour les prochaines sessions
+    if materialized and is_current and wagons_count_df is not None and location in (None, "AMB"):
+        save_stock_timeline(corrected_df, _materialized_scope(location))
+
+    return entry
+
+def _get_process_pool():
+    """Retourne le pool de processus partagé, créé au premier calcul parallèle"""
+    global _process_pool
+    with _process_pool_lock:
+        if _process_pool is None:
+            # spawn : un fork du serveur multi-thread pourrait hériter de verrous tenus
+            _process_pool = ProcessPoolExecutor(max_workers=PARALLEL_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _process_pool
+
+def compute_corrected_stocks_parallel(trains_data, corrections, max_workers=None):
+    """Calcule les chronologies brutes et corrigées de tous les lieux sur un pool de processus.
+
+    Les lieux sont répartis en groupes contigus (dans l'ordre alphabétique) ; chaque groupe
+    reçoit les seuls trains et corrections qui le concernent. Les résultats sont concaténés
+    dans l'ordre des groupes, ce qui reproduit le résultat du calcul séquentiel.
+    Retourne le couple (chronologie brute, chronologie corrigée).
+    """
+    max_workers = max_workers or PARALLEL_WORKERS
+    departure_points = trains_data['DEPARTURE_POINT']
+    arrival_points = trains_data['ARRIVAL_POINT']
+    locations = np.sort(pd.concat([departure_points, arrival_points]).dropna().unique())
+    chunks = [chunk for chunk in np.array_split(locations, max_workers) if len(chunk)]
+
+    try:
+        pool = _get_process_pool()
+        futures = [
+            pool.submit(
+                _compute_locations_chunk,
+                trains_data[departure_points.isin(chunk) | arrival_points.isin(chunk)],
+                corrections[corrections['LOCATION'].isin(chunk)],
+                list(chunk),
+            )
+            for chunk in chunks
+        ]
+        results = [future.result() for future in futures]
+    except Exception as e:
+        print(f"Erreur lors du calcul parallèle des stocks, calcul séquentiel : {e}")
+        results = []
+
+    if not results:
+        wagons_count_df = stocks_from_trains(trains_data)
+        return wagons_count_df, correct_stocks(wagons_count_df, corrections)
+
+    wagons_count_df = pd.concat([base for base, _ in results], ignore_index=True)
+    corrected_df = pd.concat([corrected for _, corrected in results], ignore_index=True)
+    return wagons_count_df, corrected_df
+
+def _compute_locations_chunk(trains_data, corrections, locations):
+    """Calcule les chronologies brutes et corrigées d'un groupe de lieux (exécuté dans un processus)"""
+    wagons_count_df = stocks_from_trains(trains_data)
+    wagons_count_df = wagons_count_df[wagons_count_df['location'].isin(locations)]
+    return wagons_count_df, correct_stocks(wagons_count_df, corrections)
+
+def _materialized_scope(location):
+    """Périmètre de la table matérialisée contenant la chronologie d'un lieu"""
+    # Hors AMB (suivi par statut), la chronologie d'un lieu est celle de tous les lieux filtrée
+    return 'AMB' if location == "AMB" else '*'
+
+def refresh_materialized_stocks(locations):
+    """Réécrit dans la table matérialisée les seules lignes des lieux donnés.
+
+    Les lignes de chaque lieu sont celles de la chronologie de tous les lieux conservée en
+    mémoire si elle existe, sinon elles sont calculées pour ce seul lieu.
+    """
+    with _stocks_store_lock:
+        all_locations_in_store = None in _stocks_store
+
+    for location in locations:
+        if all_locations_in_store:
+            corrected_df = _get_stocks_entry(None, materialized=False)['corrected']
+        else:
+            _, corrected_df = _compute_locations_chunk(get_cached_trains_data_for_compute(location), get_cached_events_for_compute(location), [location])
+        save_stock_timeline(corrected_df, _materialized_scope(None), location)
+        if location == "AMB":
+            save_stock_timeline(_get_stocks_entry("AMB", materialized=False)['corrected'], _materialized_scope("AMB"), location)
+
+def build_stock_index(stocks_df):
+    """Construit un index de consultation ponctuelle à partir d'une chronologie de stocks.
+
+    Pour chaque série (lieu, ou couple (lieu, statut) si la colonne status est présente),
+    l'index conserve les dates de changement triées et le stock après chacune d'elles.
+    """
+    keys = ['location', 'status'] if 'status' in stocks_df.columns else ['location']
+    stock_index = {}
+    if stocks_df.empty:
+        return stock_index
+
+    # Ne garder que la dernière valeur de chaque date (ordre de la chronologie conservé)
+    change_points = stocks_df.astype({'datetime': 'datetime64[ns]'}).sort_values(keys + ['datetime'], kind='stable')
+    change_points = change_points.drop_duplicates(subset=keys + ['datetime'], keep='last')
+
+    for key, positions in change_points.groupby(keys if len(keys) > 1 else keys[0], sort=False).indices.items():
+        stock_index[key] = (
+            change_points['datetime'].to_numpy()[positions],
+            change_points['nombre_wagons'].to_numpy()[positions],
+        )
+
+    return stock_index
+
+def stock_at(stock_index, location, ts, status=None):
+    """Stock d'un lieu à une date, ou à plusieurs dates à la fois (recherche dichotomique).
+
+    Si l'index distingue les statuts et qu'aucun statut n'est précisé, les stocks de tous
+    les statuts du lieu sont additionnés. Avant le premier changement, le stock vaut 0.
+    """
+    timestamps = np.asarray(pd.to_datetime(ts), dtype='datetime64[ns]')
+
+    if status is not None:
+        keys = [(location, status)]
+    elif location in stock_index:
+        keys = [location]
+    else:
+        keys = [key for key in stock_index if isinstance(key, tuple) and key[0] == location]
+
+    result = np.zeros(timestamps.shape)
+    for key in keys:
+        times, values = stock_index.get(key, (np.array([], dtype='datetime64[ns]'), np.array([])))
+        positions = np.searchsorted(times, timestamps, side='right') - 1
+        if len(values):
+            result = result + np.where(positions >= 0, values[positions.clip(0)], 0)
+
+    return result.item() if result.ndim == 0 else result
+
+def stocks_at(stock_index, ts):
+    """Stock de toutes les séries de l'index à une date donnée"""
+    timestamp = np.datetime64(pd.Timestamp(ts), 'ns')
+    stocks = {}
+    for key, (times, values) in stock_index.items():
+        position = np.searchsorted(times, timestamp, side='right') - 1
+        stocks[key] = values[position] if position >= 0 else 0
+
+    return pd.Series(stocks, name='nombre_wagons', dtype=float)
+
+def choose_resample_frequency(start, end, max_points=RESAMPLE_MAX_POINTS):
+    """Résolution la plus fine couvrant la période en au plus `max_points` intervalles"""
+    span = pd.Timestamp(end) - pd.Timestamp(start)
+    for freq in RESAMPLE_FREQUENCIES:
+        if span / pd.Timedelta(freq) <= max_points:
+            return freq
+    return RESAMPLE_FREQUENCIES[-1]
+
+def resample_stocks(stocks_df, start, end, freq=None, max_points=RESAMPLE_MAX_POINTS):
+    """Réduit une chronologie de stocks à la période affichée, par intervalles de temps.
+
+    Chaque série (lieu, et statut pour AMB) est ramenée à un point par intervalle portant
+    le dernier stock de l'intervalle (nombre_wagons) ainsi que son minimum et son maximum
+    (nombre_wagons_min, nombre_wagons_max). Le stock en vigueur au début de la période est
+    repris comme premier point. Si la période contient peu de points, la chronologie
+    détaillée est conservée.
+    """
+    keys = ['location', 'status'] if 'status' in stocks_df.columns else ['location']
+    columns = ['datetime'] + keys + ['nombre_wagons', 'nombre_wagons_min', 'nombre_wagons_max']
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+
+    if stocks_df.empty:
+        return pd.DataFrame(columns=columns)
+
+    frame = stocks_df.astype({'datetime': 'datetime64[ns]'}).sort_values(keys + ['datetime'], kind='stable')
+
+    # Stock de chaque série au début de la période, suivi des points de la période
+    opening = frame[frame['datetime'] < start].drop_duplicates(subset=keys, keep='last').assign(datetime=start)
+    window = frame[(frame['datetime'] >= start) & (frame['datetime'] <= end)]
+    window = pd.concat([opening, window], ignore_index=True).sort_values(keys + ['datetime'], kind='stable')
+
+    nb_series = max(window.drop_duplicates(subset=keys).shape[0], 1)
+    if freq is None and len(window) <= max_points * nb_series:
+        window = window.assign(nombre_wagons_min=window['nombre_wagons'], nombre_wagons_max=window['nombre_wagons'])
+        return window[columns].reset_index(drop=True)
+
+    freq = freq or choose_resample_frequency(start, end, max_points)
+    # Intervalles alignés sur le début de la période (dt.floor les alignerait sur l'epoch,
+    # et le premier intervalle de 7 jours pourrait commencer avant `start`)
+    step = pd.Timedelta(freq)
+    window['datetime'] = start + ((window['datetime'] - start) // step) * step
+    resampled = window.groupby(keys + ['datetime'], sort=True)['nombre_wagons'].agg(
+        nombre_wagons='last', nombre_wagons_min='min', nombre_wagons_max='max'
+    ).reset_index()
+
+    # Le stock au début d'un intervalle est le dernier stock de l'intervalle précédent
+    previous = resampled.groupby(keys)['nombre_wagons'].shift()
+    dtype = resampled['nombre_wagons'].dtype
+    resampled['nombre_wagons_min'] = np.fmin(resampled['nombre_wagons_min'], previous).astype(dtype)
+    resampled['nombre_wagons_max'] = np.fmax(resampled['nombre_wagons_max'], previous).astype(dtype)
+
+    return resampled[columns].sort_values(['location', 'datetime'], kind='stable').reset_index(drop=True)
+
+def patch_corrected_stocks(corrected_df, wagons_count_df, corrections, location, patched_location, since):
+    """Recalcule la chronologie corrigée d'un lieu à partir d'une date.
+
+    Les lignes antérieures à `since` et celles des autres lieux sont conservées telles
+    quelles : une correction ne modifie les stocks qu'à partir de sa date.
+    """
+    block = np.flatnonzero(corrected_df['location'].to_numpy() == patched_location)
+    if len(block) == 0:
+        return corrected_df
+    start, end = block[0], block[-1] + 1
+
+    # Chronologie corrigée du seul lieu concerné (tous statuts confondus pour AMB)
+    serie_df = wagons_count_df[wagons_count_df['location'] == patched_location]
+    serie_df = correct_stocks(serie_df, corrections[corrections['LOCATION'] == patched_location], location)
+    serie_suffix = serie_df[serie_df['datetime'] >= since]
+
+    # Remplacer uniquement la fin de la chronologie du lieu
+    block_dates = corrected_df['datetime'].to_numpy(dtype='datetime64[ns]')[start:end]
+    suffix_start = start + np.searchsorted(block_dates, np.datetime64(since, 'ns'), side='left')
+
+    return pd.concat([corrected_df.iloc[:suffix_start], serie_suffix, corrected_df.iloc[end:]], ignore_index=True)
+
+def _on_data_invalidated(table, scopes=()):
+    """Met à jour les chronologies conservées après une modification des données"""
+    global _stocks_store_generation
+
+    # Les résultats en cache sont versionnés par table ; seules les chronologies réelles
+    # conservées ici dépendent des trains et des corrections
+    if table == 'sim_events':
+        return
+
+    localized = table == 'events' and scopes and all(location is not None and since is not None for location, since in scopes)
+    with _stocks_store_lock:
+        _stocks_store_generation += 1
+        if localized:
+            # Corrections localisées : seule la fin de la chronologie des lieux sera recalculée
+            for key, entry in _stocks_store.items():
+                for location, since in scopes:
+                    if key is None or key == location:
+                        entry['pending'].append((location, pd.Timestamp(since)))
+        else:
+            _stocks_store.clear()
+
+    # Mettre à jour la table matérialisée lue par les nouvelles sessions : lignes des seuls lieux
+    # modifiés, en une fois pour toute la modification ; sinon elle sera recalculée à la prochaine lecture
+    if localized:
+        refresh_materialized_stocks(list(dict.fromkeys(location for location, _ in scopes)))
+    else:
+        delete_stock_timeline()
+
+register_invalidation_callback(_on_data_invalidated)
+
+def correct_stocks(wagons_count_df, corrections, location=None):
+    """Applique les corrections (relatives ou inventaires) à une chronologie de stocks.
+
+    Les corrections sont triées une seule fois puis positionnées dans chaque série
+    (lieu, et statut pour AMB) par recherche dichotomique. Leur effet est cumulé
+    en un décalage appliqué en une seule passe sur les lignes de la série.
+    """
     if corrections.empty:
         return wagons_count_df
-    
+
     # Créer une copie du dataframe pour éviter de modifier l'original
     wagons_count_df1 = wagons_count_df.copy()
-    
+
     # Trier les corrections par date
     corrections = corrections.sort_values('EVENT_DATE').reset_index(drop=True)
-    
+
+    # Pour AMB, les wagons vides et pleins forment deux séries distinctes
+    by_status = location == "AMB" and 'status' in wagons_count_df1.columns
+    if by_status:
+        corrections['status'] = corrections['TYPE'].map({'empty': 'vides', 'full': 'pleins'})
+        rows_groups = wagons_count_df1.groupby(['location', 'status'], sort=False).indices
+        corrections_groups = corrections.groupby(['LOCATION', 'status'], sort=False).indices
+    else:
+        rows_groups = wagons_count_df1.groupby('location', sort=False).indices
+        corrections_groups = corrections.groupby('LOCATION', sort=False).indices
+
+    datetimes = wagons_count_df1['datetime'].to_numpy(dtype='datetime64[ns]')
+    values = wagons_count_df1['nombre_wagons'].to_numpy()
+    event_dates = corrections['EVENT_DATE'].to_numpy(dtype='datetime64[ns]')
+    nb_wagons = corrections['NB_WAGONS'].to_numpy()
+    is_relative = corrections['RELATIVE'].to_numpy(dtype=bool)
+
+    offsets = np.zeros(len(wagons_count_df1), dtype=np.result_type(values.dtype, nb_wagons.dtype))
+    no_rows = np.array([], dtype=np.intp)
+
     # Liste pour stocker toutes les nouvelles lignes de correction
     nouvelles_lignes = []
-    
-    # Pour chaque lieu dans les données de wagons
+
+    # Pour chaque série de données de wagons (lieu, et statut pour AMB)
     for loc in wagons_count_df1['location'].unique():
-        # Filtrer les corrections pour ce lieu
-        loc_corrections = corrections[corrections['LOCATION'] == loc]
-        
-        if loc_corrections.empty:
-            continue
-            
-        # Filtrer les données de wagons pour ce lieu
-        loc_mask = wagons_count_df1['location'] == loc
-        loc_data = wagons_count_df1[loc_mask].copy()
-
-        # Pour AMB, traiter séparément les wagons vides et pleins
-        if location == "AMB" and 'status' in loc_data.columns:
-            # Appliquer les corrections pour chaque statut (vides/pleins)
-            for status in ['vides', 'pleins']:
-                status_data = loc_data[loc_data['status'] == status].copy()
-                status_corrections = loc_corrections[loc_corrections['TYPE'] == ('empty' if status == 'vides' else 'full')]
-                
-                if status_corrections.empty:
-                    continue
-                
-                # Appliquer les corrections chronologiquement pour ce statut
-                for _, correction in status_corrections.iterrows():
-                    correction_date = correction['EVENT_DATE']
-                    nb_wagons = correction['NB_WAGONS']
-                    is_relative = correction['RELATIVE']
-
-                    # Trouver les indices des lignes avant et après cette date pour ce statut
-                    past_mask = status_data['datetime'] < correction_date
-                    future_mask = status_data['datetime'] >= correction_date
-
-                    # Calculer la valeur avant correction
-                    if past_mask.any():
-                        valeur_avant = status_data[past_mask]['nombre_wagons'].iloc[-1]
-                    else:
-                        valeur_avant = 0
-
-                    # Calculer la nouvelle valeur selon le type de correction
-                    if is_relative:
-                        # Correction relative : ajouter/soustraire le nombre de wagons
-                        nouvelle_valeur = valeur_avant + nb_wagons
-                        # Appliquer la correction aux données futures
-                        if future_mask.any():
-                            status_data.loc[future_mask, 'nombre_wagons'] += nb_wagons
-                    else:
-                        # Correction absolue : définir directement le nombre de wagons
-                        nouvelle_valeur = nb_wagons
-                        # Calculer la différence à appliquer
-                        difference = nb_wagons - valeur_avant
-                        # Appliquer la différence aux données futures
-                        if future_mask.any():
-                            status_data.loc[future_mask, 'nombre_wagons'] += difference
-
-                    # Créer une nouvelle ligne avec la correction
-                    nouvelle_ligne = {
-                        'datetime': correction_date,
-                        'location': loc,
-                        'status': status,
-                        'nombre_wagons': nouvelle_valeur
-                    }
-                    
-                    nouvelles_lignes.append(nouvelle_ligne)
-                
-                # Mettre à jour les données pour ce statut
-                status_mask = (loc_data['location'] == loc) & (loc_data['status'] == status)
-                wagons_count_df1.loc[status_mask, 'nombre_wagons'] = status_data['nombre_wagons']
-        else:
-            # Pour les autres lieux, traiter toutes les corrections normalement
-            # Appliquer les corrections chronologiquement
-            for _, correction in loc_corrections.iterrows():
-                correction_date = correction['EVENT_DATE']
-                nb_wagons = correction['NB_WAGONS']
-                is_relative = correction['RELATIVE']
+        for status in (['vides', 'pleins'] if by_status else [None]):
+            key = (loc, status) if by_status else loc
+            if key not in corrections_groups:
+                continue
 
-                # Trouver les indices des lignes avant et après cette date
-                past_mask = loc_data['datetime'] < correction_date
-                future_mask = loc_data['datetime'] >= correction_date
+            rows = rows_groups.get(key, no_rows)
+            serie_values = values[rows]
+            correction_indices = corrections_groups[key]
+
+            # Position de chaque correction : nombre de lignes strictement antérieures
+            positions = np.searchsorted(datetimes[rows], event_dates[correction_indices], side='left')
+
+            # Décalage introduit à chaque position, cumulé ensuite sur la série
+            deltas = np.zeros(len(rows) + 1, dtype=offsets.dtype)
+            applied = 0  # décalage déjà visible sur la ligne précédant la position courante
+            pending = 0  # décalage des corrections partageant la position courante
+            current_position = 0
+
+            # Appliquer les corrections chronologiquement
+            for correction_idx, position in zip(correction_indices, positions):
+                if position != current_position:
+                    applied += pending
+                    pending = 0
+                    current_position = position
 
                 # Calculer la valeur avant correction
-                if past_mask.any():
-                    valeur_avant = loc_data[past_mask]['nombre_wagons'].iloc[-1]
-                else:
-                    valeur_avant = 0
+                valeur_avant = serie_values[position - 1] + applied if position > 0 else 0
 
-                # Calculer la nouvelle valeur selon le type de correction
-                if is_relative:
+                if is_relative[correction_idx]:
                     # Correction relative : ajouter/soustraire le nombre de wagons
-                    nouvelle_valeur = valeur_avant + nb_wagons
-                    # Appliquer la correction aux données futures
-                    if future_mask.any():
-                        loc_data.loc[future_mask, 'nombre_wagons'] += nb_wagons
+                    difference = nb_wagons[correction_idx]
+                    nouvelle_valeur = valeur_avant + nb_wagons[correction_idx]
                 else:
                     # Correction absolue : définir directement le nombre de wagons
-                    nouvelle_valeur = nb_wagons
-                    # Calculer la différence à appliquer
-                    difference = nb_wagons - valeur_avant
-                    # Appliquer la différence aux données futures
-                    if future_mask.any():
-                        loc_data.loc[future_mask, 'nombre_wagons'] += difference
-
-                # Créer une nouvelle ligne avec la correction
-                nouvelle_ligne = {
-                    'datetime': correction_date,
-                    'location': loc,
-                    'nombre_wagons': nouvelle_valeur
-                }
-                
-                # Ajouter les colonnes supplémentaires si elles existent
-                if 'status' in wagons_count_df1.columns:
-                    if not loc_data.empty:
-                        # S'assurer que c'est une valeur scalaire, pas une Series
-                        status_values = loc_data['status'].values
-                        status_value = status_values[0] if len(status_values) > 0 else None
-                    else:
-                        status_value = None
-                    nouvelle_ligne['status'] = status_value
-                
-                nouvelles_lignes.append(nouvelle_ligne)
-            
-            # Mettre à jour le dataframe principal
-            wagons_count_df1.loc[loc_mask, 'nombre_wagons'] = loc_data['nombre_wagons']
-    
+                    difference = nb_wagons[correction_idx] - valeur_avant
+                    nouvelle_valeur = nb_wagons[correction_idx]
+
+                pending += difference
+                deltas[position] += difference
+
+                if by_status:
+                    status_value = status
+                elif 'status' in wagons_count_df1.columns and len(rows) > 0:
+                    status_value = wagons_count_df1['status'].iat[rows[0]]
+                else:
+                    status_value = None
+                nouvelles_lignes.append((correction_idx, loc, status_value, nouvelle_valeur))
+
+            # Appliquer le décalage cumulé aux lignes de la série
+            offsets[rows] += np.cumsum(deltas[:-1])
+
+    wagons_count_df1['nombre_wagons'] = values + offsets
+
     # Ajouter toutes les nouvelles lignes de correction en une seule fois
     if nouvelles_lignes:
-        nouvelles_lignes_df = pd.DataFrame(nouvelles_lignes)
+        correction_indices, locs, statuses, nouvelles_valeurs = zip(*nouvelles_lignes)
+        nouvelles_lignes_df = pd.DataFrame({
+            'datetime': corrections['EVENT_DATE'].to_numpy()[list(correction_indices)],
+            'location': locs,
+            'nombre_wagons': nouvelles_valeurs,
+        })
+        if 'status' in wagons_count_df1.columns:
+            nouvelles_lignes_df['status'] = statuses
         wagons_count_df1 = pd.concat([wagons_count_df1, nouvelles_lignes_df], ignore_index=True)
-    
+
     # Trier le dataframe final par datetime et location
     wagons_count_df1 = wagons_count_df1.sort_values(['location', 'datetime']).reset_index(drop=True)
-    
+
     return wagons_count_df1
 
-def compute_stocks(location=None, simulation:bool=False, sim_events:pd.DataFrame=None):
-    """Calcule les stocks de wagons pour une période donnée et une localisation donnée avec optimisation"""
+def compute_stocks(location=None, simulation:bool=False, sim_events:pd.DataFrame=None, engine:str=None):
+    """Calcule les stocks de wagons pour une période donnée et une localisation donnée avec optimisation
+
+    Avec le moteur "sql" (engine, ou STOCK_ENGINE par défaut), la chronologie réelle est calculée
+    par la base et seul le résultat est transféré. Les simulations restent calculées en pandas.
+    """
+    if not simulation and (engine or STOCK_ENGINE) == "sql":
+        wagons_count_df = get_stock_timeline_from_warehouse(location, with_status=(location == "AMB"))
+        if wagons_count_df is not None:
+            return wagons_count_df
 
     if not simulation:
         # Récupérer les données des trains avec cache
         trains_data = get_cached_trains_data_for_compute(location)
     else:
         trains_data = apply_simulation(get_cached_trains_data_for_compute(None), location, sim_events)
-    
+
+    return stocks_from_trains(trains_data, location, with_status=(location == "AMB"))
+
+def stocks_from_trains(trains_data, location=None, with_status=False):
+    """Calcule la chronologie des stocks de wagons à partir d'une liste de trains"""
+
     # Vérifier si les données sont vides
     if trains_data.empty:
         # Retourner un DataFrame vide avec les bonnes colonnes
-        if location == "AMB":
+        if with_status:
             return pd.DataFrame(columns=['datetime', 'location', 'status', 'nombre_wagons'])
         else:
             return pd.DataFrame(columns=['datetime', 'location', 'nombre_wagons'])
     
-    # Créer une liste pour stocker tous les événements (arrivées et départs)
-    events = []
-
-    # Optimisation : traiter les données par chunks pour éviter la surcharge mémoire
-    chunk_size = 1000
-    total_trains = len(trains_data)
-    
-    for start_idx in range(0, total_trains, chunk_size):
-        end_idx = min(start_idx + chunk_size, total_trains)
-        chunk_data = trains_data.iloc[start_idx:end_idx]
-        
-        for _, row in chunk_data.iterrows():
-            departure_date = row['DEPARTURE_DATE']
-            arrival_date = row['ARRIVAL_DATE']
-            nb_wagons = row['NB_WAGONS']
-
-            if pd.notna(departure_date):
-                to_append = {
-                    'datetime': departure_date,
-                    'location': row['DEPARTURE_POINT'],
-                    'train_id': row['TRAIN_ID'],
-                    'event_type': 'departure',
-                    'change': -nb_wagons,  # Le train quitte ce lieu
-                }
-                if location == "AMB":
-                    to_append['status'] = "pleins" if row['TYPE'] == "Chargés" else "vides"
-                events.append(to_append)
-
-            if pd.notna(arrival_date):
-                to_append = {
-                    'datetime': arrival_date,
-                    'location': row['ARRIVAL_POINT'],
-                    'train_id': row['TRAIN_ID'],
-                    'event_type': 'arrival',
-                    'change': nb_wagons,  # Le train arrive dans ce lieu
-                }
-                if location == "AMB":
-                    to_append['status'] = "pleins" if row['TYPE'] == "Evac" or row['TYPE'] == "Chargés" else "vides"
-                events.append(to_append)
+    # Construire le journal des événements (arrivées et départs) de façon vectorisée
+    events_df = build_events(trains_data, with_status=with_status)
 
     # Vérifier si des événements ont été créés
-    if not events:
+    if events_df.empty:
         # Retourner un DataFrame vide avec les bonnes colonnes
-        if location == "AMB":
+        if with_status:
             return pd.DataFrame(columns=['datetime', 'location', 'status', 'nombre_wagons'])
         else:
             return pd.DataFrame(columns=['datetime', 'location', 'nombre_wagons'])
 
-    # Convertir en DataFrame et trier par datetime
-    events_df = pd.DataFrame(events)
-    
     # Supprimer les doublons exacts (même train, même lieu, même datetime, même type)
-    if location == "AMB":
+    if with_status:
         events_df = events_df.drop_duplicates(subset=['datetime', 'location', 'train_id', 'event_type', 'status']).reset_index(drop=True)
     else:
         events_df = events_df.drop_duplicates(subset=['datetime', 'location', 'train_id', 'event_type']).reset_index(drop=True)
     
     # Vérifier si le DataFrame n'est pas vide après suppression des doublons
     if events_df.empty:
-        if location == "AMB":
+        if with_status:
             return pd.DataFrame(columns=['datetime', 'location', 'status', 'nombre_wagons'])
         else:
             return pd.DataFrame(columns=['datetime', 'location', 'nombre_wagons'])
@@ -253,13 +575,13 @@ def compute_stocks(location=None, simulation:bool=False, sim_events:pd.DataFrame
     events_df = events_df.sort_values(['location', 'datetime']).reset_index(drop=True)
 
     # Calculer le nombre cumulé de trains par lieu et datetime
-    if location == "AMB":
+    if with_status:
         events_df['cumulative_wagons'] = events_df.groupby(['location', 'status'])['change'].cumsum()
     else:
         events_df['cumulative_wagons'] = events_df.groupby('location')['change'].cumsum()
 
     # Créer le dataframe final avec le nombre de trains à chaque moment et lieu
-    if location == "AMB":
+    if with_status:
         train_count_df = events_df[['datetime', 'location', 'status', 'cumulative_wagons']].copy()
         train_count_df = train_count_df.rename(columns={'cumulative_wagons': 'nombre_wagons'})
     else:
@@ -271,32 +593,290 @@ def compute_stocks(location=None, simulation:bool=False, sim_events:pd.DataFrame
     
     return train_count_df
 
+def compute_window_stocks(location=None, start=None, end=None):
+    """Calcule la chronologie corrigée d'un lieu sur la fenêtre [start, end] uniquement.
+
+    Seuls les trains de la fenêtre sont lus. Le stock brut de chaque série avant la fenêtre est
+    calculé par la base (get_opening_stocks) et placé à la date du dernier événement antérieur
+    à start, comme stock d'ouverture. Pour chaque correction antérieure à la fenêtre, la base
+    fournit de même le stock brut à sa date, placé à la date du dernier événement qui la précède.
+    Aucun point n'est ainsi ajouté entre deux événements réels : les corrections (relatives ou
+    inventaires) trouvent la même valeur avant correction que sur la chronologie complète.
+    Le résultat contient les points de la fenêtre précédés, pour chaque série, du dernier point
+    antérieur à start (stock en vigueur au début de la fenêtre).
+    """
+    with_status = location == "AMB"
+    keys = ['location', 'status'] if with_status else ['location']
+    subset = ['datetime', 'location', 'train_id', 'event_type'] + (['status'] if with_status else [])
+    start, end = pd.Timestamp(start), pd.Timestamp(end)
+
+    corrections = get_cached_events_for_compute(location)
+    earlier_dates = corrections.loc[corrections['EVENT_DATE'] < start, 'EVENT_DATE'] if not corrections.empty else pd.Series(dtype='datetime64[ns]')
+    balance_dates = tuple(sorted(set(pd.to_datetime(earlier_dates)) | {start}))
+    balances = get_cached_opening_stocks(balance_dates, location, with_status)
+    if balances is None:
+        # Stocks d'ouverture indisponibles : chronologie complète
+        return get_corrected_stocks(location)
+    balances = balances.rename(columns={'LOCATION': 'location', 'STATUS': 'status', 'NB_WAGONS': 'nombre_wagons'})
+
+    # Événements de la fenêtre, cumulés à partir du stock d'ouverture de chaque série
+    trains_data = get_cached_trains_data(location, start, end)
+    if trains_data.empty:
+        trains_data = pd.DataFrame(columns=['TRAIN_ID', 'DEPARTURE_POINT', 'ARRIVAL_POINT', 'DEPARTURE_DATE', 'ARRIVAL_DATE', 'NB_WAGONS', 'TYPE'])
+    events_df = build_events(trains_data, with_status=with_status).drop_duplicates(subset=subset)
+    events_df = events_df[(events_df['datetime'] >= start) & (events_df['datetime'] <= end)]
+    if location:
+        events_df = events_df[events_df['location'] == location]
+    events_df = events_df.astype({'datetime': 'datetime64[ns]'}).sort_values(['location', 'datetime'], kind='stable')
+    events_df['change'] = pd.to_numeric(events_df['change'])  # Colonne object si la fenêtre ne contient aucun train
+    opening = balances[balances['BALANCE_DATE'] == start]
+    events_df = events_df.merge(opening[keys + ['nombre_wagons']].rename(columns={'nombre_wagons': 'opening'}), on=keys, how='left')
+    events_df['nombre_wagons'] = events_df.groupby(keys)['change'].cumsum() + pd.to_numeric(events_df['opening']).fillna(0).astype(events_df['change'].dtype)
+
+    # Points de contrôle des corrections antérieures et stock d'ouverture, chacun à la date du
+    # dernier événement qui le précède (un seul point par date)
+    checkpoints = balances.rename(columns={'LAST_DATE': 'datetime'}).dropna(subset=['datetime'])
+    checkpoints = checkpoints.astype({'datetime': 'datetime64[ns]'}).drop_duplicates(subset=keys + ['datetime'])
+
+    columns = ['datetime', 'location', 'status', 'nombre_wagons'] if with_status else ['datetime', 'location', 'nombre_wagons']
+    wagons_count_df = pd.concat([checkpoints[columns], events_df[columns]], ignore_index=True)
+    wagons_count_df['nombre_wagons'] = pd.to_numeric(wagons_count_df['nombre_wagons'])
+    wagons_count_df = wagons_count_df.sort_values(['location', 'datetime'], kind='stable').reset_index(drop=True)
+
+    # Points de la fenêtre, précédés du dernier point antérieur de chaque série
+    corrected_df = correct_stocks(wagons_count_df, corrections, location)
+    before = (corrected_df['datetime'] < start).to_numpy()
+    last_before = corrected_df[before].reset_index().drop_duplicates(subset=keys, keep='last')['index'].to_numpy()
+    keep = ~before & (corrected_df['datetime'] <= end).to_numpy()
+    keep[last_before] = True
+    return corrected_df[keep].reset_index(drop=True)
+
+def compute_simulated_stocks(location=None, sim_events:pd.DataFrame=None):
+    """Calcule les stocks simulés comme les stocks réels plus un différentiel creux.
+
+    Seuls les événements des trains ajoutés, supprimés ou modifiés par la simulation
+    sont recalculés : les points réels des événements retirés sont supprimés et un point
+    est ajouté pour chaque événement simulé, comme dans le calcul complet.
+    """
+    real_stocks = compute_stocks_cached(location)
+    if sim_events is None or sim_events.empty:
+        return real_stocks
+
+    with_status = location == "AMB"
+    delta_events = simulation_delta_events(get_cached_trains_data_for_compute(None), sim_events, with_status=with_status)
+    if location:
+        delta_events = delta_events[delta_events['location'] == location]
+    return apply_simulation_delta(real_stocks, delta_events, with_status=with_status)
+
+def apply_simulation_delta(real_stocks, delta_events, with_status=False):
+    """Ajoute à une chronologie réelle le différentiel d'une simulation (simulation_delta_events)"""
+    keys = ['location', 'status'] if with_status else ['location']
+    if delta_events.empty:
+        return real_stocks
+
+    # Variation cumulée du différentiel pour chaque série
+    delta_events = delta_events.sort_values(keys + ['datetime'], kind='stable')
+    delta_events['datetime'] = delta_events['datetime'].astype('datetime64[ns]')
+    delta_events['delta_wagons'] = delta_events.groupby(keys)['change'].cumsum()
+    delta_points = delta_events[['datetime'] + keys + ['delta_wagons']].sort_values('datetime', kind='stable')
+
+    real_stocks = real_stocks.reset_index(drop=True)
+    affected = real_stocks.set_index(keys).index.isin(delta_points.set_index(keys).index)
+
+    # Retirer un point réel par événement retiré à la même date ; les premiers points d'une
+    # même date sont retirés pour conserver le dernier, qui porte le stock à cette date
+    kept = real_stocks[affected].astype({'datetime': 'datetime64[ns]'})
+    removed_counts = delta_events[delta_events['removed']].groupby(['datetime'] + keys).size().rename('_removed')
+    kept = kept.join(removed_counts, on=['datetime'] + keys)
+    kept = kept[kept.groupby(['datetime'] + keys).cumcount() >= kept['_removed'].fillna(0)].drop(columns=['_removed'])
+
+    # Décaler les points réels conservés des séries touchées du différentiel cumulé à leur date
+    adjusted = kept
+    adjusted['_order'] = np.arange(len(adjusted))
+    adjusted = pd.merge_asof(adjusted.sort_values('datetime', kind='stable'), delta_points, on='datetime', by=keys, direction='backward')
+    adjusted['nombre_wagons'] = adjusted['nombre_wagons'] + adjusted['delta_wagons'].fillna(0).astype(adjusted['nombre_wagons'].dtype)
+    adjusted = adjusted.sort_values('_order').drop(columns=['_order', 'delta_wagons'])
+
+    # Ajouter un point à chaque événement simulé : stock réel à cette date + différentiel cumulé
+    real_points = real_stocks[affected].astype({'datetime': 'datetime64[ns]'}).sort_values('datetime', kind='stable')
+    added_points = delta_events.loc[~delta_events['removed'], ['datetime'] + keys + ['delta_wagons']].sort_values('datetime', kind='stable')
+    added = pd.merge_asof(added_points, real_points[['datetime'] + keys + ['nombre_wagons']], on='datetime', by=keys, direction='backward')
+    added['nombre_wagons'] = added['nombre_wagons'].fillna(0) + added['delta_wagons']
+    if real_stocks['nombre_wagons'].dtype.kind in 'iu':
+        added['nombre_wagons'] = added['nombre_wagons'].astype(real_stocks['nombre_wagons'].dtype)
+    added = added.drop(columns=['delta_wagons'])
+
+    simulated_stocks = pd.concat([real_stocks[~affected], adjusted, added], ignore_index=True)[real_stocks.columns]
+    return simulated_stocks.sort_values(['location', 'datetime'], kind='stable').reset_index(drop=True)
+
+def simulation_delta_events(trains_data, sim_events, with_status=False):
+    """Construit les événements différentiels d'une simulation par rapport au réel.
+
+    Les événements réels des trains supprimés ou modifiés sont retirés (variation opposée,
+    colonne removed à True) et ceux des trains tels qu'ils existent dans la simulation sont
+    ajoutés.
+    """
+    subset = ['datetime', 'location', 'train_id', 'event_type', 'status'] if with_status else ['datetime', 'location', 'train_id', 'event_type']
+
+    # Trains réels visés par une suppression ou une modification
+    touched_ids = sim_events.loc[sim_events["MODIFICATION_TYPE"].isin(["deleted", "modified"]), "TRAIN_ID"].dropna().unique()
+    real_trains = trains_data[trains_data["TRAIN_ID"].isin(touched_ids)]
+    simulated_trains = apply_simulation(real_trains, None, sim_events)
+
+    removed = build_events(real_trains, with_status=with_status).drop_duplicates(subset=subset)
+    removed['change'] = -removed['change']
+    removed['removed'] = True
+    added = build_events(simulated_trains, with_status=with_status).drop_duplicates(subset=subset)
+    added['removed'] = False
+
+    return pd.concat([removed, added], ignore_index=True)
+
+def evaluate_simulations(simulation_ids, location=None, with_stocks:bool=False):
+    """Évalue plusieurs simulations à partir de la chronologie réelle commune.
+
+    Retourne un dictionnaire contenant une synthèse par simulation et par série (stock minimum,
+    maximum et final). Les séries sont les lieux, ou les couples (lieu, statut) pour AMB.
+    Chaque simulation est calculée comme dans apply_corrections(delta=True) : différentiel
+    creux ajouté aux stocks réels puis corrections, sur les seuls lieux qu'elle touche ; les
+    autres lieux reprennent la synthèse de la chronologie réelle corrigée. Les valeurs sont
+    donc celles des graphiques, points intermédiaires d'une même date compris.
+    Avec with_stocks=True, le dictionnaire contient aussi la chronologie corrigée des lieux
+    touchés par chaque simulation.
+    """
+    with_status = location == "AMB"
+    keys = ['location', 'status'] if with_status else ['location']
+
+    trains_data = get_cached_trains_data_for_compute(None)
+    corrections = get_cached_events_for_compute(location)
+
+    # Synthèse de la chronologie réelle corrigée, commune à toutes les simulations
+    real_summary = _summarize_stocks(get_corrected_stocks(location), keys)
+    real_stocks = compute_stocks_cached(location)
+    location_rows = real_stocks.groupby('location', sort=False).indices
+
+    summaries = []
+    stocks = {}
+    for simulation_id in simulation_ids:
+        delta_events = simulation_delta_events(trains_data, get_sim_events(simulation_id), with_status=with_status)
+        if location:
+            delta_events = delta_events[delta_events['location'] == location]
+        touched = np.sort(delta_events['location'].unique())
+
+        # Lieux touchés : chronologie simulée puis corrections, lieu par lieu (tous statuts pour AMB)
+        rows = np.concatenate([location_rows.get(touched_location, np.array([], dtype=np.intp)) for touched_location in touched]) if len(touched) else np.array([], dtype=np.intp)
+        simulated_df = apply_simulation_delta(real_stocks.iloc[np.sort(rows)], delta_events, with_status=with_status)
+        simulated_df = correct_stocks(simulated_df, corrections[corrections['LOCATION'].isin(touched)], location)
+        if with_stocks:
+            stocks[simulation_id] = simulated_df
+
+        summary = pd.concat([
+            real_summary[~real_summary['location'].isin(touched)],
+            _summarize_stocks(simulated_df, keys),
+        ], ignore_index=True)
+        summaries.append(summary.sort_values(keys, kind='stable').assign(simulation_id=simulation_id))
+
+    columns = ['simulation_id'] + keys + ['stock_min', 'stock_max', 'stock_final']
+    result = {
+        'simulations': list(simulation_ids),
+        'summary': pd.concat(summaries, ignore_index=True)[columns] if summaries else pd.DataFrame(columns=columns),
+    }
+    if with_stocks:
+        result['stocks'] = stocks
+    return result
+
+def _summarize_stocks(stocks_df, keys):
+    """Stock minimum, maximum et final de chaque série d'une chronologie"""
+    return stocks_df.groupby(keys, sort=True)['nombre_wagons'].agg(
+        stock_min='min', stock_max='max', stock_final='last'
+    ).astype(float).reset_index()
+
+def build_events(trains_data, with_status=False):
+    """Construit le journal des départs et arrivées des trains sous forme colonnaire.
+
+    Les départs et arrivées sont empilés puis entrelacés (départ puis arrivée de chaque train)
+    pour conserver l'ordre de l'ancien parcours ligne à ligne.
+    """
+    nb_trains = len(trains_data)
+    nb_wagons = trains_data['NB_WAGONS'].to_numpy()
+
+    departures = pd.DataFrame({
+        'datetime': trains_data['DEPARTURE_DATE'].to_numpy(),
+        'location': trains_data['DEPARTURE_POINT'].to_numpy(),
+        'train_id': trains_data['TRAIN_ID'].to_numpy(),
+        'event_type': 'departure',
+        'change': -nb_wagons,  # Le train quitte ce lieu
+    })
+    arrivals = pd.DataFrame({
+        'datetime': trains_data['ARRIVAL_DATE'].to_numpy(),
+        'location': trains_data['ARRIVAL_POINT'].to_numpy(),
+        'train_id': trains_data['TRAIN_ID'].to_numpy(),
+        'event_type': 'arrival',
+        'change': nb_wagons,  # Le train arrive dans ce lieu
+    })
+
+    if with_status:
+        train_types = trains_data['TYPE'].to_numpy()
+        departures['status'] = np.where(train_types == "Chargés", "pleins", "vides")
+        arrivals['status'] = np.where((train_types == "Evac") | (train_types == "Chargés"), "pleins", "vides")
+
+    # Entrelacer départs et arrivées : [départ 0, arrivée 0, départ 1, arrivée 1, ...]
+    order = np.arange(2 * nb_trains).reshape(2, nb_trains).T.ravel()
+    events = pd.concat([departures, arrivals], ignore_index=True).take(order)
+
+    return events[events['datetime'].notna()].reset_index(drop=True)
+
 def apply_simulation(all_trains_data, location, sim_events):
-    """Applique une simulation aux stocks"""
-
-    for _, row in sim_events.iterrows():
-        if row["MODIFICATION_TYPE"] == "added":
-            new_row = {
-                "TRAIN_ID": "SIM_"+row["DEPARTURE_POINT"]+"_"+row["ARRIVAL_POINT"]+"_"+row["DEPARTURE_TIME"].strftime("%Y%m%d"),
-                "DEPARTURE_POINT": row["DEPARTURE_POINT"],
-                "ARRIVAL_POINT": row["ARRIVAL_POINT"],
-                "DEPARTURE_DATE": row["DEPARTURE_TIME"],
-                "ARRIVAL_DATE": row["ARRIVAL_TIME"],
-                "NB_WAGONS": row["NB_WAGONS"],
-                "TYPE": "Vides" if row["IS_EMPTY"] else "Chargés",
-            }
-            all_trains_data = pd.concat([all_trains_data, pd.DataFrame([new_row])], ignore_index=True)
-        elif row["MODIFICATION_TYPE"] == "deleted":
-            all_trains_data = all_trains_data[all_trains_data["TRAIN_ID"] != row["TRAIN_ID"]]
-        elif row["MODIFICATION_TYPE"] == "modified":
-            all_trains_data.loc[all_trains_data["TRAIN_ID"] == row["TRAIN_ID"], ["DEPARTURE_DATE", "ARRIVAL_DATE", "DEPARTURE_POINT", "ARRIVAL_POINT", "NB_WAGONS", "TYPE"]] = [
-                row["DEPARTURE_TIME"],
-                row["ARRIVAL_TIME"], 
-                row["DEPARTURE_POINT"],
-                row["ARRIVAL_POINT"],
-                row["NB_WAGONS"],
-                "Vides" if row["IS_EMPTY"] else "Chargés"
-            ]
+    """Applique une simulation aux stocks
+
+    Les événements sont traités par lots selon leur type (un ajout groupé, une
+    anti-jointure pour les suppressions et une mise à jour par identifiant pour les
+    modifications). L'ordre de saisie est respecté : un événement ne concerne que les
+    trains présents au moment où il a été saisi.
+    """
+
+    if not sim_events.empty:
+        sim_events = sim_events.reset_index(drop=True)
+        modification_types = sim_events["MODIFICATION_TYPE"]
+
+        # Ajouts : une seule concaténation, chaque train ajouté garde son rang de saisie
+        added = sim_events[modification_types == "added"]
+        departure_times = pd.to_datetime(added["DEPARTURE_TIME"])
+        new_rows = pd.DataFrame({
+            "TRAIN_ID": "SIM_" + added["DEPARTURE_POINT"] + "_" + added["ARRIVAL_POINT"] + "_" + departure_times.dt.strftime("%Y%m%d"),
+            "DEPARTURE_POINT": added["DEPARTURE_POINT"],
+            "ARRIVAL_POINT": added["ARRIVAL_POINT"],
+            "DEPARTURE_DATE": added["DEPARTURE_TIME"],
+            "ARRIVAL_DATE": added["ARRIVAL_TIME"],
+            "NB_WAGONS": added["NB_WAGONS"],
+            "TYPE": np.where(added["IS_EMPTY"], "Vides", "Chargés"),
+        })
+        sequence = np.concatenate([np.full(len(all_trains_data), -1), added.index.to_numpy()])
+        all_trains_data = pd.concat([all_trains_data, new_rows], ignore_index=True)
+        train_ids = all_trains_data["TRAIN_ID"]
+
+        # Suppressions : anti-jointure sur la dernière suppression saisie pour chaque train
+        deleted = sim_events[modification_types == "deleted"].dropna(subset=["TRAIN_ID"])
+        last_deleted = pd.Series(deleted.index, index=deleted["TRAIN_ID"]).groupby(level=0).max()
+        keep = sequence > train_ids.map(last_deleted).fillna(-2).to_numpy()
+
+        # Modifications : la dernière modification saisie après l'ajout du train l'emporte
+        modified = sim_events[modification_types == "modified"].dropna(subset=["TRAIN_ID"])
+        last_modified = pd.Series(modified.index, index=modified["TRAIN_ID"]).groupby(level=0).max()
+        modification_rank = train_ids.map(last_modified).fillna(-2).to_numpy()
+        to_update = keep & (modification_rank > sequence)
+
+        if to_update.any():
+            updates = sim_events.loc[modification_rank[to_update].astype(int)]
+            all_trains_data.loc[to_update, ["DEPARTURE_DATE", "ARRIVAL_DATE", "DEPARTURE_POINT", "ARRIVAL_POINT", "NB_WAGONS", "TYPE"]] = np.column_stack([
+                updates["DEPARTURE_TIME"].to_numpy(dtype=object),
+                updates["ARRIVAL_TIME"].to_numpy(dtype=object),
+                updates["DEPARTURE_POINT"].to_numpy(dtype=object),
+                updates["ARRIVAL_POINT"].to_numpy(dtype=object),
+                updates["NB_WAGONS"].to_numpy(dtype=object),
+                np.where(updates["IS_EMPTY"], "Vides", "Chargés").astype(object),
+            ])
+
+        all_trains_data = all_trains_data[keep]
 
     all_trains_data = all_trains_data.sort_values(by="DEPARTURE_DATE").reset_index(drop=True)
     if location is not None:
@@ -306,4 +886,4 @@ def apply_simulation(all_trains_data, location, sim_events):
         ]
 
 
-    return all_trains_data
\ No newline at end of file
+    return all_trains_data
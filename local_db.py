@@ -0,0 +1,168 @@
+import re
+import sqlite3
+import threading
+from datetime import date, datetime
+
+import pandas as pd
+import pyarrow as pa
+
+# Base locale SQLite : même schéma et même interface que le connecteur Snowflake
+# (curseurs, paramètres %s, fetch_arrow_all, commit/rollback) pour exécuter l'application,
+# les imports et les calculs sans compte Snowflake (démonstrations, mesures de performance).
+
+TIMESTAMP_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+LOCAL_DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS trains (
+    train_id VARCHAR, departure_point VARCHAR, arrival_point VARCHAR,
+    departure_date TIMESTAMP, arrival_date TIMESTAMP, nb_wagons INTEGER, type VARCHAR
+);
+CREATE INDEX IF NOT EXISTS trains_departure_date ON trains (departure_date);
+CREATE INDEX IF NOT EXISTS trains_arrival_date ON trains (arrival_date);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, location VARCHAR, event_date TIMESTAMP,
+    nb_wagons INTEGER, relative BOOLEAN, comment VARCHAR, type VARCHAR
+);
+CREATE TABLE IF NOT EXISTS simulations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, name VARCHAR,
+    created_at TIMESTAMP, last_modified_at TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS sim_events (
+    simulation_id INTEGER, modification_type VARCHAR, train_id VARCHAR,
+    departure_time TIMESTAMP, arrival_time TIMESTAMP, departure_point VARCHAR,
+    arrival_point VARCHAR, nb_wagons INTEGER, is_empty BOOLEAN
+);
+CREATE INDEX IF NOT EXISTS sim_events_simulation_id ON sim_events (simulation_id);
+"""
+
+# Dates stockées en texte : relues en datetime, y compris pour les colonnes calculées (MIN, UNION...)
+_TIMESTAMP_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}(\.\d+)?$')
+
+# Traduction des quelques fonctions Snowflake utilisées par process_data
+_SQL_REWRITES = [
+    (re.compile(r'TO_TIMESTAMP_NTZ\(([^()]*)\)'), r'\1'),
+    (re.compile(r'FROM VALUES ([^\n]*)'), r'FROM (VALUES \1)'),
+]
+
+sqlite3.register_converter('BOOLEAN', lambda value: bool(int(value)))
+sqlite3.register_converter('TIMESTAMP', lambda value: value.decode())
+sqlite3.register_converter('TIMESTAMP_NTZ', lambda value: value.decode())
+
+_schema_lock = threading.Lock()
+
+def _to_sql_value(value):
+    """Convertit un paramètre Python/pandas/numpy en valeur acceptée par SQLite"""
+    if value is None:
+        return None
+    if isinstance(value, (datetime, pd.Timestamp)):
+        return None if pd.isna(value) else value.strftime(TIMESTAMP_FORMAT)
+    if isinstance(value, date):
+        return value.strftime(TIMESTAMP_FORMAT)
+    if hasattr(value, 'item'):
+        value = value.item()  # Scalaire numpy
+    if isinstance(value, float) and value != value:
+        return None  # NaN
+    return value
+
+def _from_sql_value(value):
+    """Relit les dates stockées en texte sous forme de datetime"""
+    if isinstance(value, str) and _TIMESTAMP_PATTERN.match(value):
+        return datetime.fromisoformat(value)
+    return value
+
+class LocalCursor:
+    """Curseur SQLite exposant l'interface utilisée du curseur Snowflake"""
+
+    def __init__(self, connection):
+        self._cursor = connection.cursor()
+        self.description = None
+
+    def execute(self, query, params=None):
+        query = query.replace('%s', '?')
+        for pattern, replacement in _SQL_REWRITES:
+            query = pattern.sub(replacement, query)
+        self._cursor.execute(query, [_to_sql_value(value) for value in (params or [])])
+        # Noms de colonnes en majuscules comme dans Snowflake
+        self.description = [(column[0].upper(),) + tuple(column[1:]) for column in self._cursor.description] if self._cursor.description else None
+        return self
+
+    def executemany(self, query, seq_of_params):
+        query = query.replace('%s', '?')
+        self._cursor.executemany(query, ([_to_sql_value(value) for value in params] for params in seq_of_params))
+        return self
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        return tuple(_from_sql_value(value) for value in row) if row is not None else None
+
+    def fetchall(self):
+        return [tuple(_from_sql_value(value) for value in row) for row in self._cursor.fetchall()]
+
+    def fetch_arrow_all(self):
+        """Retourne le résultat en table Arrow (None si aucune ligne, comme le connecteur)"""
+        rows = self.fetchall()
+        if not rows:
+            return None
+        columns = [column[0] for column in self.description]
+        return pa.table({column: [row[i] for row in rows] for i, column in enumerate(columns)})
+
+    def close(self):
+        self._cursor.close()
+
+class LocalConnection:
+    """Connexion SQLite exposant l'interface utilisée de la connexion Snowflake.
+
+    Comme les connexions du pool Snowflake, elle est en autocommit : BEGIN ouvre une
+    transaction explicite, commit() et rollback() la terminent.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(
+            path,
+            detect_types=sqlite3.PARSE_DECLTYPES,
+            isolation_level=None,
+            check_same_thread=False,  # Connexion prêtée successivement à plusieurs threads par le pool
+            timeout=30,
+        )
+        self._connection.execute("PRAGMA journal_mode=WAL")  # Lectures concurrentes pendant une écriture
+
+    def cursor(self):
+        return LocalCursor(self._connection)
+
+    def commit(self):
+        if self._connection.in_transaction:
+            self._connection.execute("COMMIT")
+
+    def rollback(self):
+        if self._connection.in_transaction:
+            self._connection.execute("ROLLBACK")
+
+    def close(self):
+        self._connection.close()
+
+    def write_pandas(self, df, table_name, **kwargs):
+        """Insère un DataFrame dans une table existante (colonnes du DataFrame = colonnes de la table).
+
+        Retourne (succès, nombre de lots, nombre de lignes, sortie) comme write_pandas du connecteur.
+        """
+        rows = df.copy()
+        for column in rows.columns:
+            if pd.api.types.is_datetime64_any_dtype(rows[column]):
+                rows[column] = rows[column].dt.strftime(TIMESTAMP_FORMAT)
+        rows = rows.astype(object).where(rows.notna(), None)
+
+        query = f"INSERT INTO {table_name} ({', '.join(rows.columns)}) VALUES ({', '.join(['?'] * len(rows.columns))})"
+        self.cursor().executemany(query, rows.itertuples(index=False, name=None))
+        return True, 1, len(rows), None
+
+def connect(path):
+    """Ouvre la base locale et crée les tables si nécessaire"""
+    conn = LocalConnection(path)
+    with _schema_lock:
+        conn._connection.executescript(LOCAL_DB_SCHEMA)
+    return conn
+
+def is_local_connection(db_handle):
+    """Indique si la connexion est celle de la base locale"""
+    return isinstance(db_handle, LocalConnection)
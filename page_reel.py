@@ -1,8 +1,8 @@
 import streamlit as st
 import plotly.express as px
 import plotly.graph_objects as go
-from process_data import get_cached_locations, get_cached_min_max_dates, get_cached_trains_data
-from compute import apply_corrections
+from process_data import get_cached_locations, get_cached_min_max_dates, get_cached_trains_data, get_cached_events, prefetch_data
+from compute import apply_corrections, build_stock_index, stock_at, resample_stocks
 from datetime import datetime
 import pandas as pd
 import pytz
@@ -17,10 +17,9 @@ def main():
     # Convertir en datetime naïf pour compatibilité avec plotly
     now_france_naive = now_france.replace(tzinfo=None)
 
-    # Chargement des données de base avec cache
-    locations = get_cached_locations()
+    # Chargement des données de base avec cache (requêtes lancées simultanément)
+    locations, (min_date_str, max_date_str) = prefetch_data((get_cached_locations,), (get_cached_min_max_dates,))
     locations.insert(0, "tous les lieux")
-    min_date_str, max_date_str = get_cached_min_max_dates()
     
     if min_date_str == None :
         st.error("Aucune donnée disponible, veuillez importer des données")
@@ -42,11 +41,36 @@ def main():
     # Calculer les stocks avec les paramètres sélectionnés
     location_param = None if selected_location == "tous les lieux" else selected_location
     
-    # Calcul des stocks avec cache
-    stocks_df = apply_corrections(location_param, simulation=False, sim_events=None)
+    # Calcul des stocks avec cache, limité à la période sélectionnée
+    period_start = datetime.combine(start_date, datetime.min.time())
+    period_end = datetime.combine(end_date, datetime.max.time().replace(microsecond=0))
+    # Corrections et trains de la période lus simultanément, puis réutilisés depuis le cache
+    prefetch_data((get_cached_events, location_param), (get_cached_trains_data, location_param, period_start, period_end))
+    stocks_df = apply_corrections(location_param, simulation=False, sim_events=None, start=period_start, end=period_end)
     
     st.write("")
 
+    # Stock à l'heure actuelle, lu dans l'index de consultation ponctuelle
+    if location_param:
+        if period_start <= now_france_naive <= period_end:
+            stock_index = build_stock_index(stocks_df)
+        else:
+            # Hors de la période : fenêtre réduite à l'heure en cours (stocks d'ouverture calculés par la
+            # base), arrondie pour rester en cache d'une réexécution de la page à l'autre
+            hour_start = pd.Timestamp(now_france_naive).floor('h')
+            stock_index = build_stock_index(apply_corrections(location_param, simulation=False, sim_events=None, start=hour_start, end=hour_start + pd.Timedelta(hours=1)))
+        if location_param == "AMB":
+            col1, col2 = st.columns(2)
+            with col1:
+                st.metric("Wagons vides maintenant", int(stock_at(stock_index, location_param, now_france_naive, status="vides")))
+            with col2:
+                st.metric("Wagons pleins maintenant", int(stock_at(stock_index, location_param, now_france_naive, status="pleins")))
+        else:
+            st.metric("Wagons maintenant", int(stock_at(stock_index, location_param, now_france_naive)))
+
+    # Ramener la chronologie à la période affichée, par intervalles si elle est longue
+    stocks_df = resample_stocks(stocks_df, period_start, period_end)
+
     # Créer le graphique
     if not stocks_df.empty:
         if selected_location == "tous les lieux":
@@ -58,6 +82,7 @@ def main():
                          color='location',
                          labels={'datetime': 'Date et heure', 'nombre_wagons': 'Nombre de wagons', 'location': 'Lieu'},
                          hover_data=['location', 'nombre_wagons'],
+                         custom_data=['nombre_wagons_min', 'nombre_wagons_max'],
                          line_shape='hv')  # Créneaux horizontaux-verticaux
             
         elif selected_location == "AMB":
@@ -68,6 +93,7 @@ def main():
                          color='status',
                          labels={'datetime': 'Date et heure', 'nombre_wagons': 'Nombre de wagons', 'status': 'Statut'},
                          hover_data=['status', 'nombre_wagons'],
+                         custom_data=['nombre_wagons_min', 'nombre_wagons_max'],
                          line_shape='hv')  # Créneaux horizontaux-verticaux
         else:
             st.write(f"#### Évolution des stocks de wagons - {selected_location}")
@@ -78,6 +104,7 @@ def main():
                          y='nombre_wagons',
                          labels={'datetime': 'Date et heure', 'nombre_wagons': 'Nombre de wagons'},
                          hover_data=['nombre_wagons'],
+                         custom_data=['nombre_wagons_min', 'nombre_wagons_max'],
                          line_shape='hv')  # Créneaux horizontaux-verticaux
         # Définir les limites de l'axe des abscisses
         fig.update_xaxes(
@@ -124,7 +151,7 @@ def main():
         # Améliorer l'affichage des tooltips pour un hover continu
         fig.update_traces(
             hovertemplate='<b>%{fullData.name}</b><br>' +
-                         '%{y} wagons<extra></extra>',
+                         '%{y} wagons (min %{customdata[0]}, max %{customdata[1]})<extra></extra>',
             hoverinfo='y+name'
         )
         
@@ -135,15 +162,12 @@ def main():
     # Section pour afficher la table des données des trains
     st.write("#### Liste des trains")
     
-    # Récupérer les données des trains avec cache
-    trains_df = get_cached_trains_data(location_param)
+    # Récupérer avec cache les seuls trains partant ou arrivant dans la période
+    trains_df = get_cached_trains_data(location_param, period_start, period_end)
     
     if not trains_df.empty:
         # Formater les dates pour un affichage plus lisible
         trains_df_display = trains_df.copy()
-        start_date = pd.Timestamp(start_date.strftime("%Y-%m-%d") + " 00:00:00")
-        end_date = pd.Timestamp(end_date.strftime("%Y-%m-%d") + " 23:59:59")
-        trains_df_display = trains_df_display[((trains_df_display['DEPARTURE_DATE'] >= start_date) & (trains_df_display['DEPARTURE_DATE'] <= end_date)) | ((trains_df_display['ARRIVAL_DATE'] >= start_date) & (trains_df_display['ARRIVAL_DATE'] <= end_date))]
         if 'DEPARTURE_DATE' in trains_df_display.columns:
             trains_df_display['DEPARTURE_DATE'] = pd.to_datetime(trains_df_display['DEPARTURE_DATE']).dt.strftime('%d/%m/%Y %H:%M')
         if 'ARRIVAL_DATE' in trains_df_display.columns:
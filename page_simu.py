@@ -4,14 +4,8 @@ from datetime import datetime
 import plotly.express as px
 import plotly.graph_objects as go
 import pytz
-from process_data import get_simulations, get_cached_locations, get_cached_min_max_dates, get_cached_trains_data, add_simulation, delete_simulation, get_sim_events, add_sim_event, delete_sim_event
-from compute import apply_corrections, apply_simulation
-
-# Cache pour les événements de simulation
-@st.cache_data(ttl=300)  # Cache pour 5 minutes
-def get_cached_sim_events(simulation_id):
-    """Version mise en cache de get_sim_events"""
-    return get_sim_events(simulation_id)
+from process_data import get_simulations, get_cached_locations, get_cached_min_max_dates, get_cached_trains_data, add_simulation, delete_simulation, get_sim_events, get_cached_sim_events, add_sim_event, delete_sim_event, apply_sim_event_changes, get_cached_events, prefetch_data
+from compute import apply_corrections, apply_simulation, evaluate_simulations_cached, resample_stocks
 
 def format_date(date_value):
     """Formate une date pour l'affichage"""
@@ -67,7 +61,19 @@ def show_simulation_edit():
 
     if len(sim_events_df) != 0:
         st.markdown("---")
-        st.subheader("Événements de simulation")
+        col1, col2 = st.columns([3, 1])
+        with col1:
+            st.subheader("Événements de simulation")
+        with col2:
+            if st.button("🗑️ Tout retirer", key="delete_all_sim_events", use_container_width=True, help="Retirer tous les événements de la simulation"):
+                # Suppression groupée : une seule transaction et une seule invalidation
+                with st.spinner("Suppression des événements..."):
+                    success = apply_sim_event_changes(simulation_id, deleted=sim_events_df)
+
+                if success:
+                    st.rerun()
+                else:
+                    st.error("❌ Erreur lors de la suppression des événements")
         
         # Affichage de la liste des événements de simulation
         # Titres de colonnes
@@ -632,6 +638,28 @@ def show_simulation_list():
                         else:
                             st.error(f"❌ Erreur lors de la suppression de la simulation '{sim['name']}'")
 
+        st.markdown("---")
+
+        # Section comparaison des simulations (évaluées ensemble en une seule passe)
+        st.subheader("📊 Comparaison des simulations")
+        name_counts = simulations_df['name'].value_counts()
+        simulation_names = {
+            sim_id: name if name_counts[name] == 1 else f"{name} ({sim_id})"
+            for sim_id, name in zip(simulations_df['id'], simulations_df['name'])
+        }
+        selected_ids = st.multiselect(
+            "Simulations à comparer",
+            list(simulation_names),
+            format_func=lambda sim_id: simulation_names[sim_id]
+        )
+
+        if selected_ids:
+            summary_df = evaluate_simulations_cached(tuple(selected_ids))['summary']
+            comparison_df = summary_df.pivot(index='location', columns='simulation_id', values=['stock_min', 'stock_max'])
+            comparison_df = comparison_df[[(metric, sim_id) for sim_id in selected_ids for metric in ['stock_min', 'stock_max']]]
+            comparison_df.columns = [f"{simulation_names[sim_id]} - {'min' if metric == 'stock_min' else 'max'}" for metric, sim_id in comparison_df.columns]
+            st.dataframe(comparison_df, use_container_width=True)
+
 def show_simulation_view():
     """Affiche la vue de simulation (reproduction de page_reel)"""
     
@@ -664,10 +692,9 @@ def show_simulation_view():
     # Convertir en datetime naïf pour compatibilité avec plotly
     now_france_naive = now_france.replace(tzinfo=None)
 
-    # Chargement des données de base avec cache
-    locations = get_cached_locations()
+    # Chargement des données de base avec cache (requêtes lancées simultanément)
+    locations, (min_date_str, max_date_str) = prefetch_data((get_cached_locations,), (get_cached_min_max_dates,))
     locations.insert(0, "tous les lieux")
-    min_date_str, max_date_str = get_cached_min_max_dates()
     
     if min_date_str == None :
         st.error("Aucune donnée disponible, veuillez importer des données")
@@ -689,9 +716,23 @@ def show_simulation_view():
     # Calculer les stocks avec les paramètres sélectionnés
     location_param = None if selected_location == "tous les lieux" else selected_location
     
-    # Calcul des stocks avec cache
-    stocks_df = apply_corrections(location_param, simulation=True, sim_events=get_sim_events(simulation_id))
+    # Trains, corrections et événements de la simulation lus simultanément, puis réutilisés depuis le cache
+    _, _, _, sim_events = prefetch_data(
+        (get_cached_trains_data, None),
+        (get_cached_trains_data, location_param),
+        (get_cached_events, location_param),
+        (get_cached_sim_events, simulation_id),
+    )
+
+    # Calcul des stocks avec cache : la simulation ne recalcule que le différentiel par rapport au réel
     real_stocks_df = apply_corrections(location_param, simulation=False, sim_events=None)
+    stocks_df = apply_corrections(location_param, simulation=True, sim_events=sim_events, delta=True)
+
+    # Ramener les chronologies à la période affichée, par intervalles si elle est longue
+    period_start = datetime.combine(start_date, datetime.min.time())
+    period_end = datetime.combine(end_date, datetime.max.time().replace(microsecond=0))
+    real_stocks_df = resample_stocks(real_stocks_df, period_start, period_end)
+    stocks_df = resample_stocks(stocks_df, period_start, period_end)
     
     st.write("")
 
@@ -706,6 +747,7 @@ def show_simulation_view():
                          color='location',
                          labels={'datetime': 'Date et heure', 'nombre_wagons': 'Nombre de wagons', 'location': 'Lieu'},
                          hover_data=['location', 'nombre_wagons'],
+                         custom_data=['nombre_wagons_min', 'nombre_wagons_max'],
                          line_shape='hv')  # Créneaux horizontaux-verticaux
             
         elif selected_location == "AMB":
@@ -729,6 +771,7 @@ def show_simulation_view():
                          color='isSimulation',
                          labels={'datetime': 'Date et heure', 'nombre_wagons': 'Nombre de wagons', 'isSimulation': 'Simulation'},
                          hover_data=['isSimulation', 'nombre_wagons'],
+                         custom_data=['nombre_wagons_min', 'nombre_wagons_max'],
                          line_shape='hv',
                          color_discrete_map=color_map)  # Créneaux horizontaux-verticaux
         else:
@@ -743,6 +786,7 @@ def show_simulation_view():
                          color='isSimulation',
                          labels={'datetime': 'Date et heure', 'nombre_wagons': 'Nombre de wagons', 'isSimulation': 'Simulation'},
                          hover_data=['isSimulation', 'nombre_wagons'],
+                         custom_data=['nombre_wagons_min', 'nombre_wagons_max'],
                          line_shape='hv')  # Créneaux horizontaux-verticaux
         # Définir les limites de l'axe des abscisses
         fig.update_xaxes(
@@ -788,7 +832,7 @@ def show_simulation_view():
         # Améliorer l'affichage des tooltips pour un hover continu
         fig.update_traces(
             hovertemplate='<b>%{fullData.name}</b><br>' +
-                         '%{y} wagons<extra></extra>',
+                         '%{y} wagons (min %{customdata[0]}, max %{customdata[1]})<extra></extra>',
             hoverinfo='y+name'
         )
         
@@ -804,7 +848,6 @@ def show_simulation_view():
     
     # Appliquer les modifications de simulation aux données des trains
     if simulation_id:
-        sim_events = get_sim_events(simulation_id)
         if not sim_events.empty:
             trains_df = apply_simulation(get_cached_trains_data(None), location_param, sim_events)
 
@@ -1,266 +1,690 @@
 import pandas as pd
 import snowflake.connector
+from snowflake.connector.pandas_tools import write_pandas
 import os
 import streamlit as st # Importez streamlit
-import warnings # Ajout pour supprimer les avertissements pandas
 from snowflake.snowpark.context import get_active_session # Importez pour la session Snowflake
 from snowflake.snowpark.session import Session
 from snowflake.snowpark.types import StructType, StructField, StringType, TimestampType, IntegerType
-from functools import lru_cache
 import threading
 import time
+import json
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.csv as pa_csv
+import pyarrow.parquet as pq
+import local_db
+import openpyxl
+import zipfile
+import hashlib
+import io
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 
-# Supprimer l'avertissement spécifique de pandas pour les connecteurs non-SQLAlchemy
-warnings.filterwarnings('ignore', message='pandas only supports SQLAlchemy connectable')
+# Pool de connexions pour l'exécution locale (hors Snowflake)
+_connection_pool = []  # Connexions libres : (connexion, date de dernière utilisation)
+_connection_leases = {}  # Connexion prêtée à chaque thread : thread -> (connexion, date du prêt)
+_connection_condition = threading.Condition()
+_connections_opened = 0
+CONNECTION_POOL_SIZE = 8  # Nombre maximal de connexions ouvertes
+CONNECTION_TIMEOUT = 300  # 5 minutes : une connexion libre inactive au-delà est fermée
+CONNECTION_HEALTH_CHECK_INTERVAL = 30  # Vérification (SELECT 1) d'une connexion restée libre plus longtemps
+CONNECTION_CHECKOUT_TIMEOUT = 30  # Attente maximale d'une connexion libre
 
-# Cache global pour les connexions
-_connection_cache = {}
-_connection_lock = threading.Lock()
-_last_connection_time = 0
-CONNECTION_TIMEOUT = 300  # 5 minutes
+# Copies locales des tables (fichiers Arrow lus en mémoire partagée par toutes les sessions)
+SNAPSHOT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".snapshots")
+# Ordre de lecture des trains : un événement en double (même train, lieu, date et type) est
+# dédoublonné en gardant le premier dans cet ordre, en pandas comme dans les requêtes SQL
+TRAINS_ORDER = "departure_date DESC, nb_wagons DESC"
+SNAPSHOT_QUERIES = {
+    'trains': f"SELECT train_id, departure_point, arrival_point, departure_date, arrival_date, nb_wagons, type FROM trains ORDER BY {TRAINS_ORDER}",
+    'events': "SELECT id, location, event_date, nb_wagons, relative, comment, type FROM events ORDER BY event_date DESC",
+    'sim_events': "SELECT * FROM sim_events",
+}
+_snapshot_locks = {table: threading.Lock() for table in SNAPSHOT_QUERIES}  # Un rafraîchissement à la fois par table
 
-def invalidate_cache():
-    """Invalide le cache des données pour forcer le rechargement"""
+# Import Excel : onglets lus (un type de train par onglet) et colonnes utiles, renommées
+EXCEL_SHEETS = ["Chargés", "Vides", "Appro", "Evac"]
+EXCEL_COLUMNS = {
+    "Train Id": "train_id",
+    "Point départ": "departure_point",
+    "Point arrivée": "arrival_point",
+    "Date départ théorique": "scheduled_departure_date",
+    "Date départ replanifiée": "rescheduled_departure_date",
+    "Date départ réelle": "actual_departure_date",
+    "Date arrivée théorique": "scheduled_arrival_date",
+    "Date arrivée replanifiée": "rescheduled_arrival_date",
+    "Date arrivée réelle": "actual_arrival_date",
+    "Nb Théo.": "theoretical_nb_wagons",
+    "Nb Comm.": "comm_nb_wagons",
+    "Nb Réel": "actual_nb_wagons"
+}
+EXCEL_BATCH_SIZE = 10000  # Lignes converties à la fois lors de la lecture en flux
+# Exports CSV et Parquet : mêmes colonnes, le type de train (nom de l'onglet Excel) dans une colonne
+IMPORT_TYPE_COLUMN = "Type"
+# Formats de date acceptés à l'import, essayés dans l'ordre sur les valeurs encore non reconnues
+IMPORT_DATE_FORMATS = ['ISO8601', '%d/%m/%Y %H:%M:%S', '%d/%m/%Y %H:%M', '%d/%m/%Y']
+
+# Pool de processus pour lire les onglets en parallèle
+_import_pool = None
+_import_pool_lock = threading.Lock()
+IMPORT_WORKERS = min(len(EXCEL_SHEETS), os.cpu_count() or 1)
+IMPORT_PARALLEL_MIN_BYTES = 1_000_000  # En dessous, le démarrage des processus coûte plus que la lecture
+
+# Fichiers déjà importés (empreinte SHA-256 -> version des trains après l'import) et cache
+# sur disque des fichiers déjà lus, par empreinte
+_imported_files = {}
+_imported_files_lock = threading.Lock()
+IMPORT_CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), ".import_cache")
+IMPORT_CACHE_MAX_FILES = 8
+
+# Lectures simultanées au chargement d'une page (voir prefetch_data)
+PREFETCH_WORKERS = 4
+
+# Colonnes d'un événement de simulation (hors simulation_id) pour les écritures groupées
+SIM_EVENT_COLUMNS = ['modification_type', 'train_id', 'departure_time', 'arrival_time',
+                     'departure_point', 'arrival_point', 'nb_wagons', 'is_empty']
+SIM_EVENTS_BATCH_SIZE = 500  # Nombre maximal de lignes par INSERT multi-lignes
+
+# Versions des tables incluses dans les clés de cache : une modification n'invalide que les
+# résultats qui dépendent de la table modifiée
+_table_versions = {}
+_table_versions_lock = threading.Lock()
+
+# Fonctions notifiées lors d'une invalidation (mise à jour incrémentale des calculs)
+_invalidation_callbacks = []
+
+def register_invalidation_callback(callback):
+    """Enregistre une fonction appelée avec (table, scopes) à chaque invalidation.
+
+    scopes est la liste des couples (lieu, date) modifiés, vide si toute la table est concernée.
+    """
+    if callback not in _invalidation_callbacks:
+        _invalidation_callbacks.append(callback)
+
+def _notify_invalidation(table, scopes=()):
+    """Notifie les fonctions enregistrées qu'une table a été modifiée"""
+    for callback in _invalidation_callbacks:
+        try:
+            callback(table, list(scopes))
+        except Exception as e:
+            print(f"Erreur lors de la notification d'invalidation : {e}")
+
+def get_table_version(table, key=None):
+    """Version courante d'une table, à inclure dans les clés de cache des résultats qui en dépendent.
+
+    Pour sim_events, key désigne une simulation : la version combine alors celle de la table
+    entière et celle de la simulation.
+    """
+    with _table_versions_lock:
+        if key is None:
+            return _table_versions.get((table, None), 0)
+        return _table_versions.get((table, None), 0), _table_versions.get((table, key), 0)
+
+def _bump_table_version(table, key=None):
+    """Incrémente la version d'une table (ou d'une simulation pour sim_events)"""
+    with _table_versions_lock:
+        _table_versions[(table, key)] = _table_versions.get((table, key), 0) + 1
+
+def invalidate_trains_cache():
+    """Invalide uniquement les résultats qui dépendent des trains (après un import)"""
+    try:
+        _bump_table_version('trains')
+        _notify_invalidation('trains')
+    except Exception as e:
+        print(f"Erreur lors de l'invalidation du cache des trains : {e}")
+
+def invalidate_events_cache(*scopes):
+    """Invalide uniquement le cache des corrections.
+
+    Chaque scope est un couple (lieu, date) : les chronologies ne sont recalculées que pour
+    ces lieux à partir de ces dates. Les scopes d'une même modification sont notifiés
+    ensemble ; sans scope, toutes les corrections sont concernées.
+    """
+    try:
+        _bump_table_version('events')
+        _notify_invalidation('events', scopes)
+    except Exception as e:
+        print(f"Erreur lors de l'invalidation du cache des corrections : {e}")
+
+def invalidate_sim_events_cache(simulation_id=None):
+    """Invalide uniquement le cache des événements d'une simulation (de toutes si simulation_id est None)"""
     try:
-        st.cache_data.clear()
-        print("Cache invalidé avec succès")
+        _bump_table_version('sim_events', simulation_id)
+        _notify_invalidation('sim_events')
     except Exception as e:
-        print(f"Erreur lors de l'invalidation du cache : {e}")
+        print(f"Erreur lors de l'invalidation du cache des simulations : {e}")
 
-# --- Nouvelle fonction utilitaire pour la connexion à Snowflake avec cache ---
-@lru_cache(maxsize=1)
+# --- Nouvelle fonction utilitaire pour la connexion à Snowflake avec pool ---
 def get_snowflake_connection_or_session():
     """
-    Établit et retourne une connexion à Snowflake avec cache intelligent.
-    Utilise la session active si l'application tourne dans Snowflake,
-    sinon utilise st.secrets pour une exécution locale avec pool de connexions.
+    Retourne la session active si l'application tourne dans Snowflake,
+    sinon une connexion du pool prêtée au thread courant (st.secrets pour l'exécution locale).
+    Le thread garde la même connexion jusqu'à release_connection() ou jusqu'à sa fin.
     """
-    global _connection_cache, _last_connection_time
-    
     try:
         # Tente d'obtenir la session active de Snowpark (indique que nous sommes dans Snowflake)
         session = get_active_session()
         return session
-        
+
     except Exception as e:
         # Si l'exception est levée, nous ne sommes probablement pas dans l'environnement Snowflake.
-        # On utilise st.secrets pour les paramètres de connexion avec cache.
-        
-        current_time = time.time()
-        
-        with _connection_lock:
-            # Vérifier si on a une connexion valide en cache
-            if 'connection' in _connection_cache:
-                last_time = _last_connection_time
-                if current_time - last_time < CONNECTION_TIMEOUT:
-                    try:
-                        # Tester si la connexion est encore valide
-                        _connection_cache['connection'].cursor().execute("SELECT 1")
-                        _last_connection_time = current_time
-                        return _connection_cache['connection']
-                    except:
-                        # Connexion invalide, on la supprime
-                        try:
-                            _connection_cache['connection'].close()
-                        except:
-                            pass
-                        del _connection_cache['connection']
-            
-            # Créer une nouvelle connexion
-            try:
-                conn = snowflake.connector.connect(
-                    user=st.secrets["SNOWFLAKE_USER"],
-                    password=st.secrets["SNOWFLAKE_PASSWORD"],
-                    account=st.secrets["SNOWFLAKE_ACCOUNT"],
-                    warehouse=st.secrets["SNOWFLAKE_WAREHOUSE"],
-                    database=st.secrets["SNOWFLAKE_DATABASE"],
-                    schema=st.secrets["SNOWFLAKE_SCHEMA"],
-                    role=st.secrets.get("SNOWFLAKE_ROLE", None),  # Optionnel
-                    autocommit=True,  # Optimisation pour les requêtes en lecture
-                    client_session_keep_alive=True,  # Garder la session active
-                    network_timeout=30,  # Timeout réseau
-                    login_timeout=30,  # Timeout de connexion
-                )
-                
-                _connection_cache['connection'] = conn
-                _last_connection_time = current_time
-                return conn
-                
-            except KeyError as key_error:
-                st.error(f"❌ Configuration manquante dans st.secrets : {key_error}")
-                st.stop()
-            except Exception as local_e:
-                st.error(f"Erreur de connexion locale à Snowflake : {local_e}")
-                raise local_e
+        return _lease_connection()
 
-# Fonction pour fermer proprement les connexions
-def close_connections():
-    """Ferme toutes les connexions en cache"""
-    global _connection_cache
-    with _connection_lock:
-        if 'connection' in _connection_cache:
+def _lease_connection():
+    """Prête au thread courant une connexion du pool (réutilisée, vérifiée ou nouvelle)"""
+    global _connections_opened
+    thread = threading.current_thread()
+    deadline = time.time() + CONNECTION_CHECKOUT_TIMEOUT
+
+    while True:
+        with _connection_condition:
+            if thread in _connection_leases:
+                return _connection_leases[thread][0]
+
+            _reclaim_dead_leases()
+            idle_connections = _evict_idle_connections()
+
+            conn, last_used = None, None
+            if _connection_pool:
+                # Connexion libre la plus récemment utilisée
+                conn, last_used = _connection_pool.pop()
+            elif _connections_opened < CONNECTION_POOL_SIZE:
+                _connections_opened += 1
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    raise TimeoutError("Aucune connexion Snowflake disponible dans le pool")
+                # Réveil périodique pour récupérer les connexions des threads terminés
+                _connection_condition.wait(min(remaining, 1.0))
+                continue
+
+        for idle_conn in idle_connections:
             try:
-                _connection_cache['connection'].close()
+                idle_conn.close()
             except:
                 pass
-            del _connection_cache['connection']
+
+        if conn is None:
+            # Ouvrir une nouvelle connexion en dehors du verrou
+            try:
+                conn = _open_connection()
+            except BaseException:
+                with _connection_condition:
+                    _connections_opened -= 1
+                    _connection_condition.notify()
+                raise
+        elif last_used is None and not _reset_connection(conn):
+            # Connexion récupérée d'un thread terminé et impossible à réinitialiser
+            _discard_connection(conn)
+            continue
+        elif last_used is not None and time.time() - last_used >= CONNECTION_HEALTH_CHECK_INTERVAL and not _is_connection_healthy(conn):
+            # Connexion invalide : la fermer et en chercher une autre
+            _discard_connection(conn)
+            continue
+
+        with _connection_condition:
+            _connection_leases[thread] = (conn, time.time())
+        return conn
+
+def release_connection():
+    """Rend au pool la connexion prêtée au thread courant"""
+    with _connection_condition:
+        lease = _connection_leases.pop(threading.current_thread(), None)
+        if lease is not None:
+            _connection_pool.append((lease[0], time.time()))
+            _connection_condition.notify()
+
+def _reclaim_dead_leases():
+    """Rend au pool les connexions prêtées à des threads terminés (verrou du pool tenu)"""
+    for thread in [thread for thread in _connection_leases if not thread.is_alive()]:
+        conn = _connection_leases.pop(thread)[0]
+        # Date None : la connexion sera réinitialisée avant d'être de nouveau prêtée
+        _connection_pool.insert(0, (conn, None))
+        _connection_condition.notify()
+
+def _evict_idle_connections():
+    """Retire du pool les connexions libres inactives depuis plus de CONNECTION_TIMEOUT.
+
+    Appelée verrou du pool tenu ; les connexions retirées sont fermées par l'appelant.
+    """
+    global _connections_opened
+    current_time = time.time()
+    idle_connections = [item for item in _connection_pool if item[1] is not None and current_time - item[1] >= CONNECTION_TIMEOUT]
+    for item in idle_connections:
+        _connection_pool.remove(item)
+        _connections_opened -= 1
+    return [conn for conn, _ in idle_connections]
+
+def _reset_connection(conn):
+    """Annule une éventuelle transaction laissée ouverte par un thread terminé"""
+    try:
+        conn.rollback()
+        return True
+    except:
+        return False
+
+def _is_connection_healthy(conn):
+    """Vérifie qu'une connexion répond encore"""
+    try:
+        cursor = conn.cursor()
+        cursor.execute("SELECT 1")
+        cursor.close()
+        return True
+    except:
+        return False
+
+def _discard_connection(conn):
+    """Ferme une connexion retirée du pool"""
+    global _connections_opened
+    try:
+        conn.close()
+    except:
+        pass
+    with _connection_condition:
+        _connections_opened -= 1
+        _connection_condition.notify()
+
+def get_local_db_path():
+    """Chemin de la base locale SQLite si elle est configurée (LOCAL_DB_PATH dans st.secrets
+    ou dans l'environnement), sinon None : l'application utilise alors Snowflake"""
+    try:
+        path = st.secrets.get("LOCAL_DB_PATH")
+    except Exception:
+        path = None  # Pas de fichier secrets.toml
+    return path or os.environ.get("LOCAL_DB_PATH")
+
+def _open_connection():
+    """Ouvre une nouvelle connexion Snowflake avec les paramètres de st.secrets,
+    ou une connexion à la base locale si LOCAL_DB_PATH est configuré"""
+    local_db_path = get_local_db_path()
+    if local_db_path:
+        return local_db.connect(local_db_path)
+
+    try:
+        return snowflake.connector.connect(
+            user=st.secrets["SNOWFLAKE_USER"],
+            password=st.secrets["SNOWFLAKE_PASSWORD"],
+            account=st.secrets["SNOWFLAKE_ACCOUNT"],
+            warehouse=st.secrets["SNOWFLAKE_WAREHOUSE"],
+            database=st.secrets["SNOWFLAKE_DATABASE"],
+            schema=st.secrets["SNOWFLAKE_SCHEMA"],
+            role=st.secrets.get("SNOWFLAKE_ROLE", None),  # Optionnel
+            autocommit=True,  # Optimisation pour les requêtes en lecture
+            client_session_keep_alive=True,  # Garder la session active
+            network_timeout=30,  # Timeout réseau
+            login_timeout=30,  # Timeout de connexion
+        )
+
+    except KeyError as key_error:
+        st.error(f"❌ Configuration manquante dans st.secrets : {key_error}")
+        st.stop()
+    except Exception as local_e:
+        st.error(f"Erreur de connexion locale à Snowflake : {local_e}")
+        raise local_e
+
+# Fonction pour fermer proprement les connexions
+def close_connections():
+    """Ferme toutes les connexions du pool, libres et prêtées"""
+    global _connections_opened
+    with _connection_condition:
+        connections = [conn for conn, _ in _connection_pool] + [conn for conn, _ in _connection_leases.values()]
+        _connection_pool.clear()
+        _connection_leases.clear()
+        _connections_opened = 0
+        _connection_condition.notify_all()
+    for conn in connections:
+        try:
+            conn.close()
+        except:
+            pass
 
 # --- Votre code existant, modifié pour utiliser get_snowflake_connection_or_session ---
 
+def _iter_excel_batches(workbook, sheet_name, batch_size=EXCEL_BATCH_SIZE):
+    """Parcourt un onglet ouvert en lecture seule et produit des lots de lignes brutes.
+
+    Seules les colonnes de EXCEL_COLUMNS sont conservées (renommées). Comme pd.read_excel,
+    les lignes vides en fin d'onglet sont ignorées.
+    """
+    sheet = workbook[sheet_name]
+    # Certains exports déclarent une dimension A1:A1 erronée : iter_rows s'y limiterait
+    # en lecture seule, on réinitialise donc les dimensions comme le fait pandas
+    if sheet.calculate_dimension() == 'A1:A1':
+        sheet.reset_dimensions()
+    rows = sheet.iter_rows(values_only=True)
+    header = list(next(rows, ()))
+    missing = [column for column in EXCEL_COLUMNS if column not in header]
+    if missing:
+        raise KeyError(f"Colonnes absentes de l'onglet {sheet_name} : {missing}")
+    positions = [header.index(column) for column in EXCEL_COLUMNS]
+
+    batch, empty_rows = [], []
+    for row in rows:
+        values = tuple(row[position] if position < len(row) else None for position in positions)
+        if all(value is None for value in values):
+            # Conservée seulement si une ligne non vide suit
+            empty_rows.append(values)
+            continue
+        batch.extend(empty_rows)
+        empty_rows = []
+        batch.append(values)
+        if len(batch) >= batch_size:
+            yield pd.DataFrame(batch, columns=list(EXCEL_COLUMNS.values()))
+            batch = []
+
+    if batch:
+        yield pd.DataFrame(batch, columns=list(EXCEL_COLUMNS.values()))
+
+def _parse_import_dates(values, column):
+    """Convertit une colonne de dates importée (texte ou dates) selon IMPORT_DATE_FORMATS.
+
+    Les valeurs non reconnues deviennent NaT. Lève ValueError si la colonne contient des
+    valeurs mais qu'aucune n'est reconnue, plutôt que d'importer des trains sans dates.
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        return values
+    dates = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    pending = values.notna()
+    for date_format in IMPORT_DATE_FORMATS:
+        if not pending.any():
+            break
+        dates[pending] = pd.to_datetime(values[pending], format=date_format, errors='coerce')
+        pending &= dates.isna()
+    if pending.any() and dates.isna().all():
+        raise ValueError(f"Dates non reconnues dans la colonne {column} (ex. {values[pending].iloc[0]!r})")
+    return dates
+
+def _prepare_trains(df, train_type):
+    """Construit les trains d'un lot de lignes brutes (colonnes renommées de EXCEL_COLUMNS).
+
+    train_type est le type commun à toutes les lignes (onglet Excel) ou une Series par ligne.
+
+    Les dates et nombres de wagons retenus sont les réels, à défaut les replanifiés (ou
+    commandés), à défaut les théoriques. VO, GRA et RIO sont regroupés en VO-GRA-RIO.
+    """
+    dates = {}
+    for col in ['scheduled_departure_date', 'rescheduled_departure_date', 'actual_departure_date',
+                'scheduled_arrival_date', 'rescheduled_arrival_date', 'actual_arrival_date']:
+        dates[col] = _parse_import_dates(df[col], col)
+    nb_wagons = {col: pd.to_numeric(df[col]) for col in ['actual_nb_wagons', 'comm_nb_wagons', 'theoretical_nb_wagons']}
+
+    return pd.DataFrame({
+        'train_id': df['train_id'],
+        # Remplacer VO, GRA et RIO par VO-GRA-RIO dans departure_point et arrival_point
+        'departure_point': df['departure_point'].replace(['VO', 'GRA', 'RIO'], 'VO-GRA-RIO'),
+        'arrival_point': df['arrival_point'].replace(['VO', 'GRA', 'RIO'], 'VO-GRA-RIO'),
+        'type': train_type,
+        'departure_date': dates['actual_departure_date'].combine_first(dates['rescheduled_departure_date']).combine_first(dates['scheduled_departure_date']),
+        'arrival_date': dates['actual_arrival_date'].combine_first(dates['rescheduled_arrival_date']).combine_first(dates['scheduled_arrival_date']),
+        'nb_wagons': nb_wagons['actual_nb_wagons'].combine_first(nb_wagons['comm_nb_wagons']).combine_first(nb_wagons['theoretical_nb_wagons']),
+    }, index=df.index)
+
+def _get_import_pool():
+    """Retourne le pool de processus d'import, créé au premier import parallèle"""
+    global _import_pool
+    with _import_pool_lock:
+        if _import_pool is None:
+            # spawn : un fork du serveur multi-thread pourrait hériter de verrous tenus
+            _import_pool = ProcessPoolExecutor(max_workers=IMPORT_WORKERS, mp_context=multiprocessing.get_context('spawn'))
+        return _import_pool
+
+def _load_excel_sheet(source, sheet_name, batch_size=EXCEL_BATCH_SIZE):
+    """Lit et convertit un onglet entier (exécuté dans un processus du pool d'import).
+
+    source est le chemin du classeur ou son contenu. Retourne None si l'onglet est vide.
+    """
+    workbook = openpyxl.load_workbook(io.BytesIO(source) if isinstance(source, bytes) else source, read_only=True, data_only=True)
+    try:
+        frames = [_prepare_trains(batch, sheet_name) for batch in _iter_excel_batches(workbook, sheet_name, batch_size)]
+    finally:
+        workbook.close()
+    return pd.concat(frames, ignore_index=True) if frames else None
+
+def _load_excel_sheets_parallel(source, progress_bar, progress_text):
+    """Lit les onglets de EXCEL_SHEETS simultanément, un processus par onglet.
+
+    Retourne les trains de chaque onglet dans l'ordre de EXCEL_SHEETS.
+    """
+    pool = _get_import_pool()
+    futures = {pool.submit(_load_excel_sheet, source, sheet_name, EXCEL_BATCH_SIZE): sheet_name for sheet_name in EXCEL_SHEETS}
+    progress_text.text(f"Chargement des onglets : {', '.join(EXCEL_SHEETS)}")
+
+    results = {}
+    for i, future in enumerate(as_completed(futures)):
+        results[futures[future]] = future.result()
+        # Mettre à jour la progression à chaque onglet terminé
+        progress_bar.progress((i + 1) / len(EXCEL_SHEETS))
+        remaining = [sheet_name for sheet_name in EXCEL_SHEETS if sheet_name not in results]
+        if remaining:
+            progress_text.text(f"Chargement des onglets : {', '.join(remaining)}")
+
+    return [results[sheet_name] for sheet_name in EXCEL_SHEETS]
+
 def load_data(file_path="excel_files/excel_poc.xlsx"):
-    """Charge et traite les données du fichier Excel"""
-    # Lire les 4 onglets du fichier Excel
+    """Charge et traite les données du fichier Excel.
+
+    Les onglets sont lus en flux (openpyxl en lecture seule) par lots de EXCEL_BATCH_SIZE lignes,
+    chaque lot étant réduit aux colonnes utiles et converti avant de lire le suivant : la mémoire
+    utilisée reste de l'ordre du résultat et non du classeur. À partir de IMPORT_PARALLEL_MIN_BYTES,
+    les onglets sont lus simultanément dans des processus séparés. Les fichiers que openpyxl ne
+    sait pas lire (.xls) passent par pd.read_excel.
+    """
+    # Contenu du fichier téléversé, ou chemin d'un fichier local
+    source = file_path.read() if hasattr(file_path, 'read') else file_path
+    is_xlsx = zipfile.is_zipfile(io.BytesIO(source) if isinstance(source, bytes) else source)
+    size = len(source) if isinstance(source, bytes) else os.path.getsize(source)
 
-    xls = pd.ExcelFile(file_path)
-    df = pd.DataFrame()
+    frames = None
 
     # Indicateur de progression pour le chargement des onglets
-    sheets = ["Chargés", "Vides", "Appro", "Evac"]
     progress_bar = st.progress(0)
     progress_text = st.empty()
 
-    for i, sheet_name in enumerate(sheets):
-        progress_text.text(f"Chargement de l'onglet : {sheet_name}")
-        df_temp = pd.read_excel(xls, sheet_name=sheet_name)[[
-            "Train Id", "Point départ", "Point arrivée", "Date départ théorique",
-            "Date départ replanifiée", "Date départ réelle", "Date arrivée théorique",
-            "Date arrivée replanifiée", "Date arrivée réelle", "Nb Théo.", "Nb Comm.", "Nb Réel"
-        ]]
-        df_temp = df_temp.rename(mapper={
-            "Train Id": "train_id",
-            "Point départ": "departure_point",
-            "Point arrivée": "arrival_point",
-            "Date départ théorique": "scheduled_departure_date",
-            "Date départ replanifiée": "rescheduled_departure_date",
-            "Date départ réelle": "actual_departure_date",
-            "Date arrivée théorique": "scheduled_arrival_date",
-            "Date arrivée replanifiée": "rescheduled_arrival_date",
-            "Date arrivée réelle": "actual_arrival_date",
-            "Nb Théo.": "theoretical_nb_wagons",
-            "Nb Comm.": "comm_nb_wagons",
-            "Nb Réel": "actual_nb_wagons"
-        }, axis='columns')
-        df_temp['type'] = sheet_name
-        df = pd.concat([df, df_temp], ignore_index=True)
-        
-        # Mettre à jour la progression
-        progress = (i + 1) / len(sheets)
-        progress_bar.progress(progress)
+    try:
+        if is_xlsx and IMPORT_WORKERS > 1 and size >= IMPORT_PARALLEL_MIN_BYTES:
+            try:
+                frames = [frame for frame in _load_excel_sheets_parallel(source, progress_bar, progress_text) if frame is not None]
+            except KeyError:
+                raise  # Colonnes absentes : la lecture séquentielle échouerait de même
+            except Exception as e:
+                print(f"Erreur lors de la lecture parallèle des onglets, lecture séquentielle : {e}")
+                progress_bar.progress(0)
+
+        if frames is None:
+            frames = _load_excel_sheets(source, is_xlsx, progress_bar, progress_text)
 
-    # Nettoyer les indicateurs de progression
-    progress_bar.empty()
-    progress_text.empty()
+    finally:
+        # Nettoyer les indicateurs de progression
+        progress_bar.empty()
+        progress_text.empty()
 
-    # Convertir les colonnes de dates en datetime
-    date_columns = ['scheduled_departure_date', 'rescheduled_departure_date', 'actual_departure_date',
-                    'scheduled_arrival_date', 'rescheduled_arrival_date', 'actual_arrival_date']
+    if not frames:
+        return pd.DataFrame(columns=['train_id', 'departure_point', 'arrival_point', 'type', 'departure_date', 'arrival_date', 'nb_wagons'])
+    return pd.concat(frames, ignore_index=True)
 
-    for col in date_columns:
-        df[col] = pd.to_datetime(df[col], format='%d/%m/%Y %H:%M:%S', errors='coerce')
+def _load_excel_sheets(source, is_xlsx, progress_bar, progress_text):
+    """Lit les onglets de EXCEL_SHEETS l'un après l'autre et retourne les lots de trains convertis"""
+    source = io.BytesIO(source) if isinstance(source, bytes) else source
+    if is_xlsx:
+        workbook = openpyxl.load_workbook(source, read_only=True, data_only=True)
+    else:
+        workbook = None
+        xls = pd.ExcelFile(source)
 
-    df['departure_date'] = df['actual_departure_date'].combine_first(df['rescheduled_departure_date']).combine_first(df['scheduled_departure_date'])
-    df['arrival_date'] = df['actual_arrival_date'].combine_first(df['rescheduled_arrival_date']).combine_first(df['scheduled_arrival_date'])
-    df['nb_wagons'] = df['actual_nb_wagons'].combine_first(df['comm_nb_wagons']).combine_first(df['theoretical_nb_wagons'])
+    frames = []
+    try:
+        for i, sheet_name in enumerate(EXCEL_SHEETS):
+            progress_text.text(f"Chargement de l'onglet : {sheet_name}")
+            if workbook is not None:
+                batches = _iter_excel_batches(workbook, sheet_name)
+            else:
+                batches = [pd.read_excel(xls, sheet_name=sheet_name)[list(EXCEL_COLUMNS)].rename(columns=EXCEL_COLUMNS)]
 
-    df.drop(columns=["actual_departure_date", "rescheduled_departure_date", "scheduled_departure_date", "actual_arrival_date", "rescheduled_arrival_date", "scheduled_arrival_date", "actual_nb_wagons", "comm_nb_wagons", "theoretical_nb_wagons"], inplace=True)
+            nb_rows = 0
+            for batch in batches:
+                frames.append(_prepare_trains(batch, sheet_name))
+                nb_rows += len(batch)
+                progress_text.text(f"Chargement de l'onglet : {sheet_name} ({nb_rows} lignes)")
 
-    # Remplacer VO, GRA et RIO par VO-GRA-RIO dans departure_point et arrival_point
-    df['departure_point'] = df['departure_point'].replace(['VO', 'GRA', 'RIO'], 'VO-GRA-RIO')
-    df['arrival_point'] = df['arrival_point'].replace(['VO', 'GRA', 'RIO'], 'VO-GRA-RIO')
+            # Mettre à jour la progression
+            progress = (i + 1) / len(EXCEL_SHEETS)
+            progress_bar.progress(progress)
 
-    return df
+    finally:
+        if workbook is not None:
+            workbook.close()
+
+    return frames
+
+TRAIN_COLUMNS = ['TRAIN_ID', 'DEPARTURE_POINT', 'ARRIVAL_POINT', 'DEPARTURE_DATE', 'ARRIVAL_DATE', 'NB_WAGONS', 'TYPE']
+
+def _typed_trains(df):
+    """Trains aux types de la table, dans l'ordre de TRAIN_COLUMNS (noms de colonnes indifférents à la casse).
+
+    Dates en TIMESTAMP_NTZ, nombre de wagons entier : les lignes du fichier et celles lues dans
+    la base ont ainsi exactement les mêmes valeurs et les mêmes empreintes.
+    """
+    df = df.rename(columns=str.upper)
+    return pd.DataFrame({
+        'TRAIN_ID': df['TRAIN_ID'].astype('string'),
+        'DEPARTURE_POINT': df['DEPARTURE_POINT'].astype('string'),
+        'ARRIVAL_POINT': df['ARRIVAL_POINT'].astype('string'),
+        'DEPARTURE_DATE': pd.to_datetime(df['DEPARTURE_DATE']).astype('datetime64[us]'),
+        'ARRIVAL_DATE': pd.to_datetime(df['ARRIVAL_DATE']).astype('datetime64[us]'),
+        'NB_WAGONS': pd.to_numeric(df['NB_WAGONS']).round().astype('Int64'),
+        'TYPE': df['TYPE'].astype('string'),
+    }).reset_index(drop=True)
+
+def diff_trains(new_trains, existing_trains, keep_existing=False):
+    """Compare les trains d'un import aux trains déjà en base sur la même période.
+
+    Chaque ligne est identifiée par l'empreinte de son contenu (train_id compris) ; les lignes
+    sont comparées comme des multi-ensembles. Retourne (à supprimer, à insérer) :
+    - à supprimer : une ligne par contenu dont des exemplaires disparaissent (tous les
+      exemplaires de ce contenu sont alors supprimés),
+    - à insérer : les lignes nouvelles, ainsi que les exemplaires à conserver d'un contenu supprimé.
+    Un train modifié apparaît dans les deux. Avec keep_existing=True, aucune ligne existante
+    n'est supprimée : seuls les exemplaires en plus de ceux déjà en base sont insérés.
+    """
+    new_trains = _typed_trains(new_trains)
+    existing_trains = _typed_trains(existing_trains)
+    new_hashes = pd.util.hash_pandas_object(new_trains, index=False)
+    existing_hashes = pd.util.hash_pandas_object(existing_trains, index=False)
+
+    counts = pd.concat([new_hashes.value_counts().rename('new'), existing_hashes.value_counts().rename('existing')], axis=1).fillna(0)
+    removed = (counts['new'] < counts['existing']) & (not keep_existing)
+
+    to_delete = existing_trains[existing_hashes.isin(counts.index[removed]) & ~existing_hashes.duplicated()]
+    # Nombre d'exemplaires de chaque contenu à insérer
+    nb_inserted = (counts['new'] - counts['existing'].where(~removed, 0)).clip(lower=0)
+    occurrence = new_hashes.groupby(new_hashes).cumcount()
+    to_insert = new_trains[occurrence.to_numpy() < nb_inserted.reindex(new_hashes).to_numpy()]
+
+    return to_delete.reset_index(drop=True), to_insert.reset_index(drop=True)
 
 def upload_data(df):
-    """Upload les données dans la base de données snowflake"""
+    """Upload les données dans la base de données snowflake.
+
+    Les trains de la période couverte par le fichier sont comparés à ceux déjà en base
+    (diff_trains) : seules les lignes ajoutées, modifiées ou disparues sont écrites, en une
+    seule instruction MERGE, et les caches ne sont invalidés que si quelque chose a changé.
+    """
     db_handle = get_snowflake_connection_or_session()
+    placeholder = "?" if isinstance(db_handle, Session) else "%s"
+    cursor = None
 
     try:
         # Obtenir les dates couvertes par l'Excel
         min_date = df['departure_date'].min()
         max_date = df['departure_date'].max()
 
-        # Formater les dates pour Snowflake
-        min_date_str = min_date.strftime('%Y-%m-%d %H:%M:%S')
-        max_date_str = max_date.strftime('%Y-%m-%d %H:%M:%S')
+        # Trains déjà en base sur cette période, et trains sans date de départ
+        progress_text = st.empty()
+        progress_text.text("Comparaison avec les données existantes...")
+        existing_query = f"""
+        SELECT {', '.join(TRAIN_COLUMNS)} FROM trains
+        WHERE (departure_date >= {placeholder} AND departure_date <= {placeholder}) OR departure_date IS NULL
+        """
+        existing_df = fetch_dataframe(db_handle, existing_query, [min_date.to_pydatetime(), max_date.to_pydatetime()])
+        if existing_df.empty:
+            existing_df = pd.DataFrame(columns=TRAIN_COLUMNS)
+
+        undated = df['departure_date'].isna()
+        existing_undated = existing_df['DEPARTURE_DATE'].isna()
+        to_delete, to_insert = diff_trains(df[~undated], existing_df[~existing_undated])
+        # Trains sans date de départ : hors période, jamais supprimés, insérés seulement s'ils sont nouveaux
+        _, undated_insert = diff_trains(df[undated], existing_df[existing_undated], keep_existing=True)
+        to_insert = pd.concat([to_insert, undated_insert], ignore_index=True)
+        nb_updated = len(set(to_delete['TRAIN_ID'].dropna()) & set(to_insert['TRAIN_ID'].dropna()))
+        print(f"Import : {len(to_insert)} lignes à insérer, {len(to_delete)} contenus à supprimer ({nb_updated} trains modifiés)")
+
+        if to_delete.empty and to_insert.empty:
+            # Rien n'a changé : pas d'écriture ni d'invalidation
+            progress_text.empty()
+            return True
+
+        progress_text.text(f"Mise à jour de la base ({len(to_insert)} ajouts, {len(to_delete)} suppressions)...")
+
+        # Changements à appliquer : D = lignes à supprimer, I = lignes à insérer
+        changes = pd.concat([to_delete.assign(CHANGE='D'), to_insert.assign(CHANGE='I')], ignore_index=True)
+        merge_query = f"""
+        MERGE INTO trains t
+        USING trains_changes s
+        ON s.change = 'D'
+            AND {' AND '.join(f"t.{column} IS NOT DISTINCT FROM s.{column}" for column in TRAIN_COLUMNS)}
+        WHEN MATCHED THEN DELETE
+        WHEN NOT MATCHED AND s.change = 'I' THEN INSERT ({', '.join(TRAIN_COLUMNS)})
+            VALUES ({', '.join(f"s.{column}" for column in TRAIN_COLUMNS)})
+        """
 
         if isinstance(db_handle, Session):
             # Environnement Snowflake - utiliser Snowpark
-            # Supprimer les données existantes pour les jours couverts par l'Excel
-            delete_query = f"""
-            DELETE FROM trains
-            WHERE departure_date >= '{min_date_str}' AND departure_date <= '{max_date_str}'
-            """
-            db_handle.sql(delete_query).collect()
-
-            # Insérer les nouvelles données en utilisant write_pandas
             db_handle.write_pandas(
-                df, 
-                table_name='trains', 
-                table_type='table', 
-                overwrite=False,
-                auto_create_table=False
+                changes,
+                table_name='TRAINS_CHANGES',
+                table_type='temporary',
+                overwrite=True,
+                auto_create_table=True,
+                use_logical_type=True
             )
-            
+            db_handle.sql(merge_query).collect()
+
+        elif local_db.is_local_connection(db_handle):
+            # Base locale (sans MERGE) : suppressions et insertions dans une même transaction
+            cursor = db_handle.cursor()
+            cursor.execute("BEGIN")
+            if not to_delete.empty:
+                delete_query = f"DELETE FROM trains WHERE {' AND '.join(f'{column} IS NOT DISTINCT FROM %s' for column in TRAIN_COLUMNS)}"
+                cursor.executemany(delete_query, to_delete.astype(object).where(to_delete.notna(), None).itertuples(index=False, name=None))
+            if not to_insert.empty:
+                db_handle.write_pandas(to_insert, table_name='TRAINS')
+            db_handle.commit()
+
         else:
             # Environnement local - utiliser snowflake.connector
+            # Changements chargés en masse (Parquet, stage temporaire, COPY INTO) puis un seul MERGE
             cursor = db_handle.cursor()
+            success, _, nb_rows, _ = write_pandas(
+                db_handle,
+                changes,
+                table_name='TRAINS_CHANGES',
+                table_type='temporary',
+                overwrite=True,
+                auto_create_table=True,
+                use_logical_type=True,
+            )
+            if not success or nb_rows != len(changes):
+                raise RuntimeError(f"Chargement incomplet : {nb_rows}/{len(changes)} lignes chargées")
+            cursor.execute(merge_query)
 
-            # Supprimer les données existantes pour les jours couverts par l'Excel
-            delete_query = f"""
-            DELETE FROM trains
-            WHERE departure_date >= '{min_date_str}' AND departure_date <= '{max_date_str}'
-            """
-            cursor.execute(delete_query)
-
-            # Insérer les nouvelles données en une seule requête
-            insert_query = """
-            INSERT INTO trains (
-                train_id, departure_point, arrival_point, departure_date,
-                arrival_date, nb_wagons, type
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s)
-            """
-
-            # Préparer toutes les données pour l'insertion en lot
-            data_to_insert = []
-            total_rows = len(df)
-            
-            # Indicateur de progression pour l'insertion
-            progress_bar = st.progress(0)
-            progress_text = st.empty()
-            
-            for idx, row in df.iterrows():
-                departure_date_str = row['departure_date'].strftime('%Y-%m-%d %H:%M:%S') if pd.notna(row['departure_date']) else None
-                arrival_date_str = row['arrival_date'].strftime('%Y-%m-%d %H:%M:%S') if pd.notna(row['arrival_date']) else None
-
-                data_to_insert.append((
-                    row['train_id'],
-                    row['departure_point'],
-                    row['arrival_point'],
-                    departure_date_str,
-                    arrival_date_str,
-                    row['nb_wagons'],
-                    row['type']
-                ))
-                
-                # Mettre à jour la progression
-                if idx % 100 == 0 or idx == total_rows - 1:  # Mise à jour tous les 100 enregistrements
-                    progress = (idx + 1) / total_rows
-                    progress_bar.progress(progress)
-                    progress_text.text(f"Préparation des données : {idx + 1}/{total_rows}")
-
-            # Exécuter l'insertion en lot
-            progress_text.text("Insertion en base de données...")
-            cursor.executemany(insert_query, data_to_insert)
-
-            # Valider les changements
-            db_handle.commit()
-            
-            # Nettoyer les indicateurs de progression
-            progress_bar.empty()
-            progress_text.empty()
+        # Nettoyer les indicateurs de progression
+        progress_text.empty()
 
-        # Invalider le cache après import de nouvelles données
-        invalidate_cache()
+        # Invalider les résultats qui dépendent des trains après import de nouvelles données
+        invalidate_trains_cache()
 
         return True
 
@@ -271,13 +695,222 @@ def upload_data(df):
         return False
 
     finally:
-        if not isinstance(db_handle, Session):
+        if not isinstance(db_handle, Session) and cursor is not None:
             cursor.close()
-            db_handle.close()
+            # Ne pas fermer la connexion : elle est rendue au pool et partagée
+
+def _prepare_exported_trains(table):
+    """Construit les trains d'un export CSV ou Parquet lu en table Arrow.
+
+    Les lignes dont le type n'est pas l'un des onglets importés (EXCEL_SHEETS) sont ignorées,
+    comme les autres onglets d'un fichier Excel.
+    """
+    df = table.to_pandas().rename(columns=EXCEL_COLUMNS)
+    df = df[df[IMPORT_TYPE_COLUMN].isin(EXCEL_SHEETS)].reset_index(drop=True)
+    return _prepare_trains(df, df.pop(IMPORT_TYPE_COLUMN))
+
+def load_csv(file_path):
+    """Charge et traite les données d'un export CSV (séparateur , ou ;, encodage UTF-8).
+
+    Le fichier est analysé par le lecteur CSV multi-thread d'Arrow, limité aux colonnes utiles ;
+    les dates restent du texte et sont converties comme pour l'import Excel (IMPORT_DATE_FORMATS).
+    """
+    source = file_path.read() if hasattr(file_path, 'read') else file_path
+    if isinstance(source, bytes):
+        header = source[:source.find(b"\n")]
+        source = pa.BufferReader(source)
+    else:
+        with open(source, 'rb') as csv_file:
+            header = csv_file.readline()
+
+    date_columns = [column for column, name in EXCEL_COLUMNS.items() if name.endswith('_date')]
+    table = pa_csv.read_csv(
+        source,
+        read_options=pa_csv.ReadOptions(use_threads=True),
+        parse_options=pa_csv.ParseOptions(delimiter=';' if header.count(b';') > header.count(b',') else ','),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=list(EXCEL_COLUMNS) + [IMPORT_TYPE_COLUMN],
+            column_types={column: pa.string() for column in date_columns},
+            strings_can_be_null=True,
+        ),
+    )
+    return _prepare_exported_trains(table)
+
+def load_parquet(file_path):
+    """Charge et traite les données d'un export Parquet.
+
+    Seules les colonnes utiles sont lues, sans copie (projection mémoire pour un fichier local,
+    lecture directe du tampon pour un fichier téléversé).
+    """
+    source = file_path.read() if hasattr(file_path, 'read') else file_path
+    table = pq.read_table(
+        pa.BufferReader(source) if isinstance(source, bytes) else source,
+        columns=list(EXCEL_COLUMNS) + [IMPORT_TYPE_COLUMN],
+        memory_map=True,
+    )
+    return _prepare_exported_trains(table)
+
+def _load_import_cache(digest):
+    """Retourne les trains lus d'un fichier depuis le cache d'import, ou None"""
+    try:
+        return pd.read_parquet(os.path.join(IMPORT_CACHE_DIR, f"{digest}.parquet"))
+    except Exception:
+        return None
+
+def _save_import_cache(digest, df):
+    """Enregistre les trains lus d'un fichier dans le cache d'import (IMPORT_CACHE_MAX_FILES fichiers au plus)"""
+    try:
+        os.makedirs(IMPORT_CACHE_DIR, exist_ok=True)
+        path = os.path.join(IMPORT_CACHE_DIR, f"{digest}.parquet")
+        # Identifiants et lieux en texte : colonnes homogènes pour Parquet, mêmes valeurs une fois importées
+        df.astype({'train_id': 'string', 'departure_point': 'string', 'arrival_point': 'string', 'type': 'string'}).to_parquet(path + ".tmp", index=False)
+        os.replace(path + ".tmp", path)
+
+        # Ne garder que les fichiers les plus récents
+        cached = sorted((entry for entry in os.scandir(IMPORT_CACHE_DIR) if entry.name.endswith(".parquet")), key=lambda entry: entry.stat().st_mtime, reverse=True)
+        for entry in cached[IMPORT_CACHE_MAX_FILES:]:
+            os.remove(entry.path)
+    except Exception as e:
+        print(f"Erreur lors de l'écriture du cache d'import : {e}")
+
+# Lecture de chaque format accepté à l'import, selon l'extension du fichier
+IMPORT_LOADERS = {
+    '.xlsx': load_data,
+    '.xls': load_data,
+    '.csv': load_csv,
+    '.parquet': load_parquet,
+}
 
-def new_excel(file):
-    df = load_data(file)
-    return upload_data(df)
+def import_file(file):
+    """Importe un fichier téléversé (ou son chemin) : Excel, CSV ou Parquet selon son extension.
+
+    Le contenu est identifié par son empreinte SHA-256 : un fichier déjà importé, sans autre
+    modification des trains depuis, n'est ni relu ni réimporté (le téléverseur de la barre
+    latérale redéclenche l'import à chaque interaction). Les trains lus sont aussi conservés
+    dans un petit cache sur disque pour ne pas relire un fichier téléversé de nouveau.
+    """
+    if hasattr(file, 'getvalue'):
+        content = file.getvalue()
+    else:
+        with open(file, 'rb') as source:
+            content = source.read()
+    name = getattr(file, 'name', file if isinstance(file, str) else '')
+    loader = IMPORT_LOADERS.get(os.path.splitext(name)[1].lower(), load_data)
+    digest = hashlib.sha256(content).hexdigest()
+
+    with _imported_files_lock:
+        if _imported_files.get(digest) == get_table_version('trains'):
+            return True
+
+    df = _load_import_cache(digest)
+    if df is None:
+        df = loader(io.BytesIO(content))
+        _save_import_cache(digest, df)
+
+    success = upload_data(df)
+    if success:
+        with _imported_files_lock:
+            _imported_files[digest] = get_table_version('trains')
+    return success
+
+def fetch_dataframe(db_handle, query, params=None):
+    """Exécute une requête de lecture et retourne le résultat sous forme de DataFrame.
+
+    Le résultat est transféré en colonnes Arrow (Snowpark to_pandas, ou fetch_arrow_all pour
+    le connecteur) sans conversion ligne à ligne. Les dates restent en datetime64 et les entiers
+    sont ramenés en int64 (Arrow choisit la plus petite largeur suffisante pour chaque lot).
+    Les paramètres utilisent ? avec Snowpark et %s avec le connecteur.
+    """
+    if isinstance(db_handle, Session):
+        # Environnement Snowflake - utiliser Snowpark
+        df = db_handle.sql(query, params=params).to_pandas()
+    else:
+        # Environnement local - utiliser snowflake.connector
+        cursor = db_handle.cursor()
+        try:
+            cursor.execute(query, params)
+            table = cursor.fetch_arrow_all()
+            columns = [column[0] for column in cursor.description]
+        finally:
+            cursor.close()
+            # Ne pas fermer la connexion car elle est mise en cache
+        df = table.to_pandas() if table is not None else pd.DataFrame(columns=columns)
+
+    for column in df.columns:
+        if df[column].dtype.kind in 'iu':
+            df[column] = df[column].astype('int64')
+
+    return df
+
+def get_table_watermark(db_handle, table):
+    """Retourne la date de dernière modification d'une table (information_schema), ou None"""
+    if local_db.is_local_connection(db_handle):
+        return None  # Base locale : déjà un fichier lu directement, pas de copie
+
+    try:
+        placeholder = "?" if isinstance(db_handle, Session) else "%s"
+        query = f"""
+        SELECT last_altered FROM information_schema.tables
+        WHERE table_schema = CURRENT_SCHEMA() AND table_name = {placeholder}
+        """
+        df = fetch_dataframe(db_handle, query, [table.upper()])
+        return str(df.iloc[0, 0]) if not df.empty else None
+
+    except Exception as e:
+        print(f"Erreur lors de la lecture de la version de la table {table} : {e}")
+        return None
+
+def get_table_snapshot(db_handle, table, row_filter=None):
+    """Retourne le contenu d'une table depuis sa copie locale, rafraîchie si la table a changé.
+
+    La copie est un fichier Arrow (SNAPSHOT_DIR) accompagné de la version de la table au moment
+    de la lecture. Elle est lue par projection mémoire : toutes les sessions et tous les processus
+    partagent les mêmes pages du fichier. row_filter (expression pyarrow.compute) est appliqué
+    à la table Arrow : seules les lignes retenues sont converties en DataFrame.
+    Retourne None si la version ne peut pas être lue.
+    """
+    watermark = get_table_watermark(db_handle, table)
+    if watermark is None:
+        return None
+
+    path = os.path.join(SNAPSHOT_DIR, f"{table}.arrow")
+    meta_path = os.path.join(SNAPSHOT_DIR, f"{table}.json")
+
+    def read_snapshot():
+        try:
+            with open(meta_path) as meta_file:
+                if json.load(meta_file).get('watermark') == watermark:
+                    with pa.memory_map(path, 'r') as source:
+                        return pa.ipc.open_file(source).read_all()
+        except (OSError, ValueError, pa.ArrowInvalid):
+            pass  # Copie absente ou illisible : elle est recréée
+        return None
+
+    # Copie à jour : lecture sans verrou (les fichiers sont remplacés de façon atomique)
+    table_data = read_snapshot()
+    if table_data is None:
+        with _snapshot_locks[table]:
+            # Une autre session a pu rafraîchir la copie pendant l'attente du verrou
+            table_data = read_snapshot()
+            if table_data is None:
+                df = fetch_dataframe(db_handle, SNAPSHOT_QUERIES[table])
+                table_data = pa.Table.from_pandas(df, preserve_index=False)
+                try:
+                    # Écriture dans des fichiers temporaires puis remplacement atomique
+                    os.makedirs(SNAPSHOT_DIR, exist_ok=True)
+                    with pa.OSFile(path + ".tmp", 'wb') as sink:
+                        with pa.ipc.new_file(sink, table_data.schema) as writer:
+                            writer.write_table(table_data)
+                    with open(meta_path + ".tmp", 'w') as meta_file:
+                        json.dump({'watermark': watermark, 'rows': len(df)}, meta_file)
+                    os.replace(path + ".tmp", path)
+                    os.replace(meta_path + ".tmp", meta_path)
+                except Exception as e:
+                    print(f"Erreur lors de l'écriture de la copie locale de {table} : {e}")
+
+    if row_filter is not None:
+        table_data = table_data.filter(row_filter)
+    return table_data.to_pandas()
 
 def get_min_max_dates():
     db_handle = get_snowflake_connection_or_session()
@@ -306,29 +939,87 @@ def get_min_max_dates():
         print(f"Erreur lors de la récupération des dates : {e}")
         return None, None
 
-# Cache pour les données fréquemment utilisées
-@st.cache_data(ttl=600)  # Cache pour 10 minutes
-def get_cached_trains_data(location=None):
+def prefetch_data(*calls):
+    """Exécute simultanément des lectures indépendantes et retourne leurs résultats dans l'ordre.
+
+    Chaque appel est un tuple (fonction, arguments...), en général une fonction get_cached_* :
+    sur un cache vide, le temps d'attente est celui de la requête la plus lente et non la somme.
+    Les threads reçoivent le contexte Streamlit de la session et rendent leur connexion au pool
+    après chaque lecture. Un même appel présent plusieurs fois n'est exécuté qu'une fois.
+    """
+    ctx = get_script_run_ctx()
+
+    def _run(call):
+        if ctx is not None:
+            add_script_run_ctx(threading.current_thread(), ctx)
+        try:
+            return call[0](*call[1:])
+        finally:
+            release_connection()
+
+    unique_calls = list(dict.fromkeys(calls))
+    with ThreadPoolExecutor(max_workers=max(1, min(PREFETCH_WORKERS, len(unique_calls)))) as executor:
+        futures = {call: executor.submit(_run, call) for call in unique_calls}
+        return [futures[call].result() for call in calls]
+
+# Cache pour les données fréquemment utilisées, versionné par table
+def get_cached_trains_data(location=None, start=None, end=None):
     """Version mise en cache de get_trains_data avec optimisation"""
-    return get_trains_data(location)
+    # datetime et pd.Timestamp ne produisent pas la même clé de cache : on normalise ici
+    # pour que les pages et compute_window_stocks partagent la même entrée
+    start = pd.Timestamp(start) if start is not None else None
+    end = pd.Timestamp(end) if end is not None else None
+    return _get_cached_trains_data(location, start, end, get_table_version('trains'))
+
+@st.cache_data(ttl=600)  # Cache pour 10 minutes
+def _get_cached_trains_data(location, start, end, trains_version):
+    return get_trains_data(location, start, end)
+
+def get_cached_opening_stocks(balance_dates:tuple, location=None, with_status:bool=False):
+    """Version mise en cache de get_opening_stocks"""
+    return _get_cached_opening_stocks(balance_dates, location, with_status, get_table_version('trains'))
+
+@st.cache_data(ttl=600)  # Cache pour 10 minutes
+def _get_cached_opening_stocks(balance_dates, location, with_status, trains_version):
+    return get_opening_stocks(balance_dates, location, with_status)
 
-@st.cache_data(ttl=1800)  # Cache pour 30 minutes (données statiques)
 def get_cached_locations():
     """Version mise en cache de get_locations"""
+    return _get_cached_locations(get_table_version('trains'))
+
+@st.cache_data(ttl=1800)  # Cache pour 30 minutes (données statiques)
+def _get_cached_locations(trains_version):
     return get_locations()
 
-@st.cache_data(ttl=600)  # Cache pour 10 minutes
 def get_cached_events(location=None):
     """Version mise en cache de get_events"""
+    return _get_cached_events(location, get_table_version('events'))
+
+@st.cache_data(ttl=600)  # Cache pour 10 minutes
+def _get_cached_events(location, events_version):
     return get_events(location)
 
-@st.cache_data(ttl=1800)  # Cache pour 30 minutes
+def get_cached_sim_events(simulation_id):
+    """Version mise en cache de get_sim_events"""
+    return _get_cached_sim_events(simulation_id, get_table_version('sim_events', simulation_id))
+
+@st.cache_data(ttl=300)  # Cache pour 5 minutes
+def _get_cached_sim_events(simulation_id, sim_events_version):
+    return get_sim_events(simulation_id)
+
 def get_cached_min_max_dates():
     """Version mise en cache de get_min_max_dates"""
+    return _get_cached_min_max_dates(get_table_version('trains'))
+
+@st.cache_data(ttl=1800)  # Cache pour 30 minutes
+def _get_cached_min_max_dates(trains_version):
     return get_min_max_dates()
 
-def get_trains_data(location=None):
-    """Récupère depuis snowflake les données des trains pour une période donnée et retourne un DataFrame pandas"""
+def get_trains_data(location=None, start=None, end=None):
+    """Récupère depuis snowflake les données des trains pour une période donnée et retourne un DataFrame pandas
+
+    Avec start et end, seuls les trains partant ou arrivant dans la fenêtre [start, end] sont lus.
+    """
     db_handle = get_snowflake_connection_or_session()
 
     try:
@@ -339,24 +1030,170 @@ def get_trains_data(location=None):
             arrival_date, nb_wagons, type
         FROM trains 
         """
+        conditions, params = [], []
         if location:
-            query += f"WHERE (departure_point = '{location}' OR arrival_point = '{location}')"
-        query += " ORDER BY departure_date DESC"
-        
-        if isinstance(db_handle, Session):
-            # Environnement Snowflake - utiliser Snowpark
-            df = db_handle.sql(query).to_pandas()
-        else:
-            # Environnement local - utiliser pandas read_sql avec chunking pour les gros datasets
-            df = pd.read_sql(query, db_handle, chunksize=10000)
-            df = pd.concat(df, ignore_index=True)
-        
-        return df
+            conditions.append("(departure_point = {0} OR arrival_point = {0})")
+            params += [location, location]
+        if start is not None and end is not None:
+            # Fenêtre de dates appliquée par la base plutôt qu'en pandas
+            conditions.append("((departure_date >= {0} AND departure_date <= {0}) OR (arrival_date >= {0} AND arrival_date <= {0}))")
+            start, end = pd.Timestamp(start).to_pydatetime(), pd.Timestamp(end).to_pydatetime()
+            params += [start, end, start, end]
+        if start is None or end is None:
+            # Table complète : lue depuis la copie locale si elle est à jour
+            row_filter = ((pc.field('DEPARTURE_POINT') == location) | (pc.field('ARRIVAL_POINT') == location)) if location else None
+            df = get_table_snapshot(db_handle, 'trains', row_filter)
+            if df is not None:
+                return df
+
+        if conditions:
+            query += "WHERE " + " AND ".join(conditions)
+        query += f" ORDER BY {TRAINS_ORDER}"
+
+        # Lecture en colonnes Arrow
+        placeholder = "?" if isinstance(db_handle, Session) else "%s"
+        return fetch_dataframe(db_handle, query.format(placeholder), params or None)
         
     except Exception as e:
         print(f"Erreur lors de la récupération des données trains : {e}")
         return pd.DataFrame()
 
+def get_opening_stocks(balance_dates, location=None, with_status=False):
+    """Calcule dans la base le stock brut (avant corrections) de chaque série à plusieurs dates.
+
+    Pour chaque date de balance_dates, retourne par lieu (et statut si with_status) la somme
+    des variations strictement antérieures (NB_WAGONS) et la date du dernier de ces événements
+    (LAST_DATE). Les événements en double d'un même train (même lieu, date, type d'événement et
+    statut) sont comptés une seule fois, même si leur nombre de wagons diffère : comme en pandas,
+    le premier dans l'ordre des trains (TRAINS_ORDER) est conservé.
+    Retourne None en cas d'erreur.
+    """
+    db_handle = get_snowflake_connection_or_session()
+    placeholder = "?" if isinstance(db_handle, Session) else "%s"
+    balance_dates = [pd.Timestamp(balance_date).to_pydatetime() for balance_date in balance_dates]
+
+    # Statut des wagons à AMB : mêmes règles que build_events
+    departure_status = ", CASE WHEN type = 'Chargés' THEN 'pleins' ELSE 'vides' END AS status" if with_status else ""
+    arrival_status = ", CASE WHEN type IN ('Evac', 'Chargés') THEN 'pleins' ELSE 'vides' END AS status" if with_status else ""
+    status_column = ", e.status" if with_status else ""
+    dedup_status = ", status" if with_status else ""
+    values_clause = ", ".join(["({0})"] * len(balance_dates))
+    departure_filter = " AND departure_point = {0}" if location else ""
+    arrival_filter = " AND arrival_point = {0}" if location else ""
+
+    try:
+        query = f"""
+        WITH all_events AS (
+            SELECT train_id, departure_point AS location, departure_date AS datetime,
+                'departure' AS event_type, -nb_wagons AS change, departure_date, nb_wagons{departure_status}
+            FROM trains
+            WHERE departure_date < TO_TIMESTAMP_NTZ({{0}}){departure_filter}
+            UNION ALL
+            SELECT train_id, arrival_point AS location, arrival_date AS datetime,
+                'arrival' AS event_type, nb_wagons AS change, departure_date, nb_wagons{arrival_status}
+            FROM trains
+            WHERE arrival_date < TO_TIMESTAMP_NTZ({{0}}){arrival_filter}
+        ),
+        stock_events AS (
+            SELECT * FROM (
+                SELECT all_events.*,
+                    ROW_NUMBER() OVER (
+                        PARTITION BY train_id, location, datetime, event_type{dedup_status}
+                        ORDER BY {TRAINS_ORDER}
+                    ) AS occurrence
+                FROM all_events
+            ) numbered_events
+            WHERE occurrence = 1
+        ),
+        balance_dates AS (
+            SELECT TO_TIMESTAMP_NTZ(column1) AS balance_date
+            FROM VALUES {values_clause}
+        )
+        SELECT d.balance_date, e.location{status_column}, SUM(e.change) AS nb_wagons, MAX(e.datetime) AS last_date
+        FROM balance_dates d
+        JOIN stock_events e ON e.datetime < d.balance_date
+        GROUP BY d.balance_date, e.location{status_column}
+        """
+        params = [max(balance_dates)] + ([location] if location else []) + [max(balance_dates)] + ([location] if location else []) + balance_dates
+
+        df = fetch_dataframe(db_handle, query.format(placeholder), params)
+        df.columns = ['BALANCE_DATE', 'LOCATION'] + (['STATUS'] if with_status else []) + ['NB_WAGONS', 'LAST_DATE']
+        df['BALANCE_DATE'] = pd.to_datetime(df['BALANCE_DATE'])
+        df['LAST_DATE'] = pd.to_datetime(df['LAST_DATE'])
+
+        return df
+
+    except Exception as e:
+        print(f"Erreur lors du calcul des stocks d'ouverture : {e}")
+        return None
+
+def get_stock_timeline_from_warehouse(location=None, with_status=False):
+    """Calcule dans la base la chronologie brute des stocks (équivalent SQL de compute_stocks).
+
+    Les départs et arrivées sont réunis (UNION ALL), dédoublonnés comme en pandas (même train,
+    lieu, date, type d'événement et statut : le premier dans l'ordre des trains est conservé),
+    puis cumulés par SUM() OVER (PARTITION BY lieu[, statut] ORDER BY date). L'ordre des trains
+    est celui de get_trains_data (TRAINS_ORDER), départ avant arrivée.
+    Retourne None en cas d'erreur.
+    """
+    db_handle = get_snowflake_connection_or_session()
+    placeholder = "?" if isinstance(db_handle, Session) else "%s"
+
+    # Statut des wagons à AMB : mêmes règles que build_events
+    departure_status = ", CASE WHEN type = 'Chargés' THEN 'pleins' ELSE 'vides' END AS status" if with_status else ""
+    arrival_status = ", CASE WHEN type IN ('Evac', 'Chargés') THEN 'pleins' ELSE 'vides' END AS status" if with_status else ""
+    status_column = ", status" if with_status else ""
+    trains_filter = " WHERE departure_point = {0} OR arrival_point = {0}" if location else ""
+    events_filter = " WHERE location = {0}" if location else ""
+
+    try:
+        query = f"""
+        WITH ranked_trains AS (
+            SELECT train_id, departure_point, arrival_point, departure_date, arrival_date, nb_wagons, type,
+                ROW_NUMBER() OVER (ORDER BY {TRAINS_ORDER}) AS train_rank
+            FROM trains{trains_filter}
+        ),
+        stock_events AS (
+            SELECT departure_date AS datetime, departure_point AS location, train_id, 'departure' AS event_type,
+                -nb_wagons AS change, train_rank, 0 AS event_order{departure_status}
+            FROM ranked_trains
+            WHERE departure_date IS NOT NULL
+            UNION ALL
+            SELECT arrival_date AS datetime, arrival_point AS location, train_id, 'arrival' AS event_type,
+                nb_wagons AS change, train_rank, 1 AS event_order{arrival_status}
+            FROM ranked_trains
+            WHERE arrival_date IS NOT NULL
+        ),
+        numbered_events AS (
+            SELECT stock_events.*,
+                ROW_NUMBER() OVER (
+                    PARTITION BY datetime, location, train_id, event_type{status_column}
+                    ORDER BY train_rank, event_order
+                ) AS occurrence
+            FROM stock_events{events_filter}
+        )
+        SELECT datetime, location{status_column},
+            SUM(change) OVER (
+                PARTITION BY location{status_column}
+                ORDER BY datetime, train_rank, event_order
+                ROWS BETWEEN UNBOUNDED PRECEDING AND CURRENT ROW
+            ) AS nombre_wagons
+        FROM numbered_events
+        WHERE occurrence = 1
+        ORDER BY location, datetime, train_rank, event_order
+        """
+        params = [location, location, location] if location else None
+
+        df = fetch_dataframe(db_handle, query.format(placeholder), params)
+        df.columns = ['datetime', 'location'] + (['status'] if with_status else []) + ['nombre_wagons']
+        df['datetime'] = pd.to_datetime(df['datetime'])
+
+        return df
+
+    except Exception as e:
+        print(f"Erreur lors du calcul des stocks dans la base : {e}")
+        return None
+
 def get_locations():
     """Récupère les locations des trains depuis snowflake avec optimisation"""
     db_handle = get_snowflake_connection_or_session()
@@ -401,24 +1238,214 @@ def get_events(location=None):
         SELECT id, location, event_date, nb_wagons, relative, comment, type
         FROM events
         """
+        # Table complète : lue depuis la copie locale si elle est à jour
+        df = get_table_snapshot(db_handle, 'events', (pc.field('LOCATION') == location) if location else None)
+        if df is not None:
+            return df
+
+        params = []
         if location:
-            query += f" WHERE location = '{location}'"
+            query += " WHERE location = {0}"
+            params.append(location)
         query += " ORDER BY event_date DESC"
+
+        # Lecture en colonnes Arrow
+        placeholder = "?" if isinstance(db_handle, Session) else "%s"
+        return fetch_dataframe(db_handle, query.format(placeholder), params or None)
         
+    except Exception as e:
+        print(f"Erreur lors de la récupération des événements : {e}")
+        return pd.DataFrame()
+
+STOCK_TIMELINE_CREATE_QUERY = """
+CREATE TABLE IF NOT EXISTS stock_timeline (
+    scope VARCHAR, seq INTEGER, datetime TIMESTAMP_NTZ,
+    location VARCHAR, status VARCHAR, nb_wagons INTEGER
+)
+"""
+
+def save_stock_timeline(stocks_df, scope, location=None):
+    """Enregistre une chronologie de stocks corrigée dans la table matérialisée stock_timeline.
+
+    scope identifie le périmètre calculé : '*' pour tous les lieux, 'AMB' pour AMB par statut.
+    La chronologie précédente du périmètre est remplacée dans la même transaction. Avec location,
+    seules les lignes de ce lieu sont remplacées, et seulement si le périmètre est déjà enregistré
+    (un périmètre absent est calculé et enregistré en entier à sa première lecture).
+    Les lignes sont chargées en masse dans une table temporaire puis copiées en une requête.
+    """
+    db_handle = get_snowflake_connection_or_session()
+
+    if location is not None:
+        stocks_df = stocks_df[stocks_df['location'] == location]
+
+    # Colonnes de la table ; seq conserve l'ordre des lignes de chaque lieu
+    rows = pd.DataFrame({
+        'SCOPE': scope,
+        'SEQ': stocks_df.groupby('location', sort=False).cumcount().to_numpy(),
+        'DATETIME': pd.to_datetime(stocks_df['datetime']).to_numpy(dtype='datetime64[ns]'),
+        'LOCATION': stocks_df['location'].to_numpy(),
+        'STATUS': stocks_df['status'].to_numpy() if 'status' in stocks_df.columns else None,
+        'NB_WAGONS': stocks_df['nombre_wagons'].to_numpy(),
+    })
+    scope_filter = "scope = {0}" + (" AND location = {0}" if location is not None else "")
+    scope_params = [scope] + ([location] if location is not None else [])
+    exists_query = "SELECT 1 FROM stock_timeline WHERE scope = {0} LIMIT 1"
+    copy_query = "INSERT INTO stock_timeline (scope, seq, datetime, location, status, nb_wagons) SELECT scope, seq, datetime, location, status, nb_wagons FROM stock_timeline_rows"
+
+    try:
         if isinstance(db_handle, Session):
             # Environnement Snowflake - utiliser Snowpark
-            df = db_handle.sql(query).to_pandas()
+            db_handle.sql(STOCK_TIMELINE_CREATE_QUERY).collect()
+            if location is not None and not db_handle.sql(exists_query.format("?"), params=[scope]).collect():
+                return True
+            if not rows.empty:
+                # Chargement hors transaction : la création du stage temporaire validerait la transaction
+                db_handle.write_pandas(rows, table_name='STOCK_TIMELINE_ROWS', table_type='temporary', overwrite=True, auto_create_table=True, use_logical_type=True)
+            db_handle.sql("BEGIN").collect()
+            db_handle.sql(f"DELETE FROM stock_timeline WHERE {scope_filter.format('?')}", params=scope_params).collect()
+            if not rows.empty:
+                db_handle.sql(copy_query).collect()
+            db_handle.sql("COMMIT").collect()
+
+        elif local_db.is_local_connection(db_handle):
+            # Base locale : suppression et insertion dans une même transaction
+            cursor = db_handle.cursor()
+            cursor.execute(STOCK_TIMELINE_CREATE_QUERY)
+            cursor.execute("BEGIN")
+            if location is not None and cursor.execute(exists_query.format("%s"), (scope,)).fetchone() is None:
+                db_handle.commit()
+                cursor.close()
+                return True
+            cursor.execute(f"DELETE FROM stock_timeline WHERE {scope_filter.format('%s')}", scope_params)
+            if not rows.empty:
+                db_handle.write_pandas(rows, table_name='stock_timeline')
+            db_handle.commit()
+            cursor.close()
+
         else:
-            # Environnement local - utiliser pandas read_sql
-            df = pd.read_sql(query, db_handle)
+            # Environnement local - utiliser snowflake.connector
+            cursor = db_handle.cursor()
+            cursor.execute(STOCK_TIMELINE_CREATE_QUERY)
+            if location is not None and cursor.execute(exists_query.format("%s"), (scope,)).fetchone() is None:
+                cursor.close()
+                return True
+            if not rows.empty:
+                # Chargement en masse (Parquet, stage temporaire, COPY INTO) hors transaction
+                success, _, nb_rows, _ = write_pandas(
+                    db_handle,
+                    rows,
+                    table_name='STOCK_TIMELINE_ROWS',
+                    table_type='temporary',
+                    overwrite=True,
+                    auto_create_table=True,
+                    use_logical_type=True,
+                )
+                if not success or nb_rows != len(rows):
+                    raise RuntimeError(f"Chargement incomplet : {nb_rows}/{len(rows)} lignes chargées")
+            cursor.execute("BEGIN")
+            cursor.execute(f"DELETE FROM stock_timeline WHERE {scope_filter.format('%s')}", scope_params)
+            if not rows.empty:
+                cursor.execute(copy_query)
+            db_handle.commit()
+            cursor.close()
             # Ne pas fermer la connexion car elle est mise en cache
-        
+
+        return True
+
+    except Exception as e:
+        if isinstance(db_handle, Session):
+            db_handle.sql("ROLLBACK").collect()
+        else:
+            db_handle.rollback()
+        print(f"Erreur lors de l'enregistrement de la chronologie des stocks : {e}")
+        return False
+
+def delete_stock_timeline(scopes=('*', 'AMB')):
+    """Supprime des chronologies de la table matérialisée stock_timeline.
+
+    Elles seront recalculées et enregistrées à leur prochaine lecture.
+    """
+    db_handle = get_snowflake_connection_or_session()
+
+    try:
+        placeholders = ', '.join(["{0}"] * len(scopes))
+        query = f"DELETE FROM stock_timeline WHERE scope IN ({placeholders})"
+        if isinstance(db_handle, Session):
+            # Environnement Snowflake - utiliser Snowpark
+            db_handle.sql(STOCK_TIMELINE_CREATE_QUERY).collect()
+            db_handle.sql(query.format("?"), params=list(scopes)).collect()
+        else:
+            # Environnement local - utiliser snowflake.connector
+            cursor = db_handle.cursor()
+            cursor.execute(STOCK_TIMELINE_CREATE_QUERY)
+            cursor.execute(query.format("%s"), list(scopes))
+            db_handle.commit()
+            cursor.close()
+            # Ne pas fermer la connexion car elle est mise en cache
+
+        return True
+
+    except Exception as e:
+        print(f"Erreur lors de la suppression de la chronologie des stocks : {e}")
+        return False
+
+def load_stock_timeline(scope, location=None):
+    """Lit une chronologie de stocks corrigée depuis la table matérialisée stock_timeline.
+
+    Retourne un DataFrame vide si la chronologie n'a pas encore été enregistrée.
+    """
+    db_handle = get_snowflake_connection_or_session()
+
+    try:
+        query = "SELECT datetime, location, status, nb_wagons FROM stock_timeline WHERE scope = {0}"
+        params = [scope]
+        if location:
+            query += " AND location = {0}"
+            params.append(location)
+        query += " ORDER BY location, seq"
+
+        placeholder = "?" if isinstance(db_handle, Session) else "%s"
+        df = fetch_dataframe(db_handle, query.format(placeholder), params)
+
+        df.columns = ['datetime', 'location', 'status', 'nombre_wagons']
+        df['datetime'] = pd.to_datetime(df['datetime'])
+        df['nombre_wagons'] = df['nombre_wagons'].astype('int64' if df['nombre_wagons'].notna().all() else 'float64')
+        if scope != 'AMB':
+            df = df.drop(columns=['status'])
+
         return df
-        
+
     except Exception as e:
-        print(f"Erreur lors de la récupération des événements : {e}")
+        print(f"Erreur lors de la lecture de la chronologie des stocks : {e}")
         return pd.DataFrame()
 
+def get_event_scope(event_id):
+    """Récupère le lieu et la date d'un événement de correction"""
+    db_handle = get_snowflake_connection_or_session()
+
+    try:
+        if isinstance(db_handle, Session):
+            # Environnement Snowflake - utiliser Snowpark
+            query = "SELECT location, event_date FROM events WHERE id = ?"
+            result = db_handle.sql(query, params=[event_id]).collect()
+            row = result[0] if result else None
+        else:
+            # Environnement local - utiliser snowflake.connector
+            cursor = db_handle.cursor()
+            query = "SELECT location, event_date FROM events WHERE id = %s"
+            cursor.execute(query, (event_id,))
+            row = cursor.fetchone()
+            cursor.close()
+            # Ne pas fermer la connexion car elle est mise en cache
+
+        if row:
+            return row[0], row[1]
+        return None, None
+
+    except Exception as e:
+        print(f"Erreur lors de la récupération de l'événement : {e}")
+        return None, None
+
 def add_event(location, event_date, nb_wagons, relative, comment, type=None):
     """Ajoute un événement à la base de données snowflake"""
     db_handle = get_snowflake_connection_or_session()
@@ -437,8 +1464,8 @@ def add_event(location, event_date, nb_wagons, relative, comment, type=None):
             cursor.close()
             # Ne pas fermer la connexion car elle est mise en cache
         
-        # Invalider le cache des événements après modification
-        invalidate_cache()
+        # Invalider le cache des événements pour ce lieu à partir de la date de la correction
+        invalidate_events_cache((location, event_date))
         
         return True
         
@@ -453,6 +1480,9 @@ def update_event(event_id, location, event_date, nb_wagons, relative, comment, t
     db_handle = get_snowflake_connection_or_session()
 
     try:
+        # Lieu et date avant modification, pour l'invalidation ciblée
+        old_location, old_event_date = get_event_scope(event_id)
+
         if isinstance(db_handle, Session):
             # Environnement Snowflake - utiliser Snowpark
             query = "UPDATE events SET location = ?, event_date = ?, nb_wagons = ?, relative = ?, comment = ?, type = ? WHERE id = ?"
@@ -466,8 +1496,13 @@ def update_event(event_id, location, event_date, nb_wagons, relative, comment, t
             cursor.close()
             # Ne pas fermer la connexion car elle est mise en cache
         
-        # Invalider le cache des événements après modification
-        invalidate_cache()
+        # Invalider le cache des événements pour l'ancien et le nouveau lieu, en une seule notification
+        if old_location is not None and old_location != location:
+            invalidate_events_cache((old_location, old_event_date), (location, event_date))
+        elif old_location is not None:
+            invalidate_events_cache((location, min(pd.Timestamp(old_event_date), pd.Timestamp(event_date))))
+        else:
+            invalidate_events_cache()
         
         return True
         
@@ -482,6 +1517,9 @@ def delete_event(event_id):
     db_handle = get_snowflake_connection_or_session()
 
     try:
+        # Lieu et date avant suppression, pour l'invalidation ciblée
+        old_location, old_event_date = get_event_scope(event_id)
+
         if isinstance(db_handle, Session):
             # Environnement Snowflake - utiliser Snowpark
             query = "DELETE FROM events WHERE id = ?"
@@ -495,8 +1533,11 @@ def delete_event(event_id):
             cursor.close()
             # Ne pas fermer la connexion car elle est mise en cache
         
-        # Invalider le cache des événements après modification
-        invalidate_cache()
+        # Invalider le cache des événements pour ce lieu à partir de la date de la correction
+        if old_location is not None:
+            invalidate_events_cache((old_location, old_event_date))
+        else:
+            invalidate_events_cache()
         
         return True
         
@@ -517,49 +1558,27 @@ def get_simulations():
             s.name, 
             s.created_at, 
             s.last_modified_at,
-            COALESCE(added_events.count, 0) as added_count,
-            COALESCE(modified_events.count, 0) as modified_count,
-            COALESCE(deleted_events.count, 0) as deleted_count
+            COALESCE(counts.added_count, 0) as added_count,
+            COALESCE(counts.modified_count, 0) as modified_count,
+            COALESCE(counts.deleted_count, 0) as deleted_count
         FROM simulations s
         LEFT JOIN (
-            SELECT simulation_id, COUNT(*) as count
-            FROM sim_events
-            WHERE modification_type = 'added'
-            GROUP BY simulation_id
-        ) added_events ON s.id = added_events.simulation_id
-        LEFT JOIN (
-            SELECT simulation_id, COUNT(*) as count
-            FROM sim_events
-            WHERE modification_type = 'modified'
-            GROUP BY simulation_id
-        ) modified_events ON s.id = modified_events.simulation_id
-        LEFT JOIN (
-            SELECT simulation_id, COUNT(*) as count
+            -- Un seul parcours de sim_events pour les trois compteurs
+            SELECT
+                simulation_id,
+                SUM(CASE WHEN modification_type = 'added' THEN 1 ELSE 0 END) as added_count,
+                SUM(CASE WHEN modification_type = 'modified' THEN 1 ELSE 0 END) as modified_count,
+                SUM(CASE WHEN modification_type = 'deleted' THEN 1 ELSE 0 END) as deleted_count
             FROM sim_events
-            WHERE modification_type = 'deleted'
             GROUP BY simulation_id
-        ) deleted_events ON s.id = deleted_events.simulation_id
+        ) counts ON s.id = counts.simulation_id
         ORDER BY s.last_modified_at DESC
         """
         
-        if isinstance(db_handle, Session):
-            # Environnement Snowflake - utiliser Snowpark
-            result = db_handle.sql(query).collect()
-            if result:
-                return pd.DataFrame(result, columns=['id', 'name', 'created_at', 'last_modified_at', 'added_count', 'modified_count', 'deleted_count'])
-            return pd.DataFrame(columns=['id', 'name', 'created_at', 'last_modified_at', 'added_count', 'modified_count', 'deleted_count'])
-        else:
-            # Environnement local - utiliser snowflake.connector
-            cursor = db_handle.cursor()
-            cursor.execute(query)
-            columns = ['id', 'name', 'created_at', 'last_modified_at', 'added_count', 'modified_count', 'deleted_count']
-            data = cursor.fetchall()
-            cursor.close()
-            # Ne pas fermer la connexion car elle est mise en cache
-            
-            if data:
-                return pd.DataFrame(data, columns=columns)
-            return pd.DataFrame(columns=columns)
+        # Lecture en colonnes Arrow
+        df = fetch_dataframe(db_handle, query)
+        df.columns = ['id', 'name', 'created_at', 'last_modified_at', 'added_count', 'modified_count', 'deleted_count']
+        return df
             
     except Exception as e:
         print(f"Erreur lors de la récupération des simulations : {e}")
@@ -647,6 +1666,9 @@ def delete_simulation(simulation_id):
             db_handle.commit()
             cursor.close()
             # Ne pas fermer la connexion car elle est mise en cache
+
+        # Les événements de la simulation ont été supprimés avec elle
+        invalidate_sim_events_cache(simulation_id)
         
         return True
         
@@ -661,32 +1683,19 @@ def get_sim_events(simulation_id):
     db_handle = get_snowflake_connection_or_session()
 
     try:
-        if isinstance(db_handle, Session):
-            # Environnement Snowflake - utiliser Snowpark
-            query = """
-            SELECT * FROM sim_events
-            WHERE simulation_id = ?
-            """
-            df = db_handle.sql(query, params=[simulation_id]).to_pandas()
-        else:
-            # Environnement local - utiliser snowflake.connector
-            query = """
-            SELECT * FROM sim_events
-            WHERE simulation_id = %s
-            """
-            cursor = db_handle.cursor()
-            cursor.execute(query, (simulation_id,))
-            columns = [desc[0] for desc in cursor.description]
-            data = cursor.fetchall()
-            cursor.close()
-            # Ne pas fermer la connexion car elle est mise en cache
-            
-            if data:
-                df = pd.DataFrame(data, columns=columns)
-            else:
-                df = pd.DataFrame(columns=columns)
-        
-        return df
+        # Table complète : lue depuis la copie locale si elle est à jour
+        df = get_table_snapshot(db_handle, 'sim_events', pc.field('SIMULATION_ID') == simulation_id)
+        if df is not None:
+            return df
+
+        query = """
+        SELECT * FROM sim_events
+        WHERE simulation_id = {0}
+        """
+
+        # Lecture en colonnes Arrow
+        placeholder = "?" if isinstance(db_handle, Session) else "%s"
+        return fetch_dataframe(db_handle, query.format(placeholder), [simulation_id])
         
     except Exception as e:
         print(f"Erreur lors de la récupération des événements de simulation : {e}")
@@ -734,7 +1743,7 @@ def add_sim_event(simulation_id, modification_type, train_id=None, departure_tim
             # Ne pas fermer la connexion car elle est mise en cache
         
         # Invalider le cache des événements de simulation après modification
-        invalidate_cache()
+        invalidate_sim_events_cache(simulation_id)
         
         return True
         
@@ -744,6 +1753,41 @@ def add_sim_event(simulation_id, modification_type, train_id=None, departure_tim
         print(f"Erreur lors de l'ajout de l'événement de simulation : {e}")
         return False
     
+def _sim_event_match_clause(placeholder, modification_type, train_id=None, departure_time=None,
+                            arrival_time=None, departure_point=None, arrival_point=None,
+                            nb_wagons=None, is_empty=None):
+    """Construit la condition SQL identifiant un événement de simulation par tous ses critères.
+
+    Une valeur absente est comparée avec IS NULL. Retourne (condition, paramètres).
+    """
+    conditions = [f"modification_type = {placeholder}"]
+    params = [modification_type]
+    values = {
+        'train_id': train_id,
+        'departure_time': departure_time,
+        'arrival_time': arrival_time,
+        'departure_point': departure_point,
+        'arrival_point': arrival_point,
+        'nb_wagons': nb_wagons,
+        'is_empty': is_empty,
+    }
+
+    for column, value in values.items():
+        if value is not None and pd.notna(value):
+            conditions.append(f"{column} = {placeholder}")
+            # Convertir le timestamp en chaîne pour Snowflake
+            if column in ('departure_time', 'arrival_time') and hasattr(value, 'strftime'):
+                value = value.strftime('%Y-%m-%d %H:%M:%S')
+            elif column in ('departure_time', 'arrival_time'):
+                value = str(value)
+            elif hasattr(value, 'item'):
+                value = value.item()  # Scalaire numpy (ligne de DataFrame) vers type Python
+            params.append(value)
+        else:
+            conditions.append(f"{column} IS NULL")
+
+    return " AND ".join(conditions), params
+
 def delete_sim_event(simulation_id, modification_type, train_id=None, departure_time=None, 
                      arrival_time=None, departure_point=None, arrival_point=None, 
                      nb_wagons=None, is_empty=None):
@@ -751,136 +1795,28 @@ def delete_sim_event(simulation_id, modification_type, train_id=None, departure_
     db_handle = get_snowflake_connection_or_session()
 
     try:
+        placeholder = "?" if isinstance(db_handle, Session) else "%s"
+        condition, params = _sim_event_match_clause(
+            placeholder, modification_type, train_id, departure_time, arrival_time,
+            departure_point, arrival_point, nb_wagons, is_empty
+        )
+        query = f"DELETE FROM sim_events WHERE simulation_id = {placeholder} AND {condition}"
+        params = [simulation_id] + params
+
         if isinstance(db_handle, Session):
             # Environnement Snowflake - utiliser Snowpark
-            query = """
-            DELETE FROM sim_events 
-            WHERE simulation_id = ? AND modification_type = ?
-            """
-            params = [simulation_id, modification_type]
-            
-            if train_id is not None and pd.notna(train_id):
-                query += " AND train_id = ?"
-                params.append(train_id)
-            else:
-                query += " AND train_id IS NULL"
-                
-            if departure_time is not None and pd.notna(departure_time):
-                query += " AND departure_time = ?"
-                # Convertir le timestamp en chaîne pour Snowflake
-                if hasattr(departure_time, 'strftime'):
-                    departure_time_str = departure_time.strftime('%Y-%m-%d %H:%M:%S')
-                else:
-                    departure_time_str = str(departure_time)
-                params.append(departure_time_str)
-            else:
-                query += " AND departure_time IS NULL"
-                
-            if arrival_time is not None and pd.notna(arrival_time):
-                query += " AND arrival_time = ?"
-                # Convertir le timestamp en chaîne pour Snowflake
-                if hasattr(arrival_time, 'strftime'):
-                    arrival_time_str = arrival_time.strftime('%Y-%m-%d %H:%M:%S')
-                else:
-                    arrival_time_str = str(arrival_time)
-                params.append(arrival_time_str)
-            else:
-                query += " AND arrival_time IS NULL"
-                
-            if departure_point is not None and pd.notna(departure_point):
-                query += " AND departure_point = ?"
-                params.append(departure_point)
-            else:
-                query += " AND departure_point IS NULL"
-                
-            if arrival_point is not None and pd.notna(arrival_point):
-                query += " AND arrival_point = ?"
-                params.append(arrival_point)
-            else:
-                query += " AND arrival_point IS NULL"
-                
-            if nb_wagons is not None and pd.notna(nb_wagons):
-                query += " AND nb_wagons = ?"
-                params.append(nb_wagons)
-            else:
-                query += " AND nb_wagons IS NULL"
-                
-            if is_empty is not None and pd.notna(is_empty):
-                query += " AND is_empty = ?"
-                params.append(is_empty)
-            else:
-                query += " AND is_empty IS NULL"
-            
             db_handle.sql(query, params=params).collect()
             
         else:
             # Environnement local - utiliser snowflake.connector
             cursor = db_handle.cursor()
-            query = """
-            DELETE FROM sim_events 
-            WHERE simulation_id = %s AND modification_type = %s
-            """
-            params = [simulation_id, modification_type]
-            
-            if train_id is not None and pd.notna(train_id):
-                query += " AND train_id = %s"
-                params.append(train_id)
-            else:
-                query += " AND train_id IS NULL"
-                
-            if departure_time is not None and pd.notna(departure_time):
-                query += " AND departure_time = %s"
-                # Convertir le timestamp en chaîne pour Snowflake
-                if hasattr(departure_time, 'strftime'):
-                    departure_time_str = departure_time.strftime('%Y-%m-%d %H:%M:%S')
-                else:
-                    departure_time_str = str(departure_time)
-                params.append(departure_time_str)
-            else:
-                query += " AND departure_time IS NULL"
-                
-            if arrival_time is not None and pd.notna(arrival_time):
-                query += " AND arrival_time = %s"
-                # Convertir le timestamp en chaîne pour Snowflake
-                if hasattr(arrival_time, 'strftime'):
-                    arrival_time_str = arrival_time.strftime('%Y-%m-%d %H:%M:%S')
-                else:
-                    arrival_time_str = str(arrival_time)
-                params.append(arrival_time_str)
-            else:
-                query += " AND arrival_time IS NULL"
-                
-            if departure_point is not None and pd.notna(departure_point):
-                query += " AND departure_point = %s"
-                params.append(departure_point)
-            else:
-                query += " AND departure_point IS NULL"
-                
-            if arrival_point is not None and pd.notna(arrival_point):
-                query += " AND arrival_point = %s"
-                params.append(arrival_point)
-            else:
-                query += " AND arrival_point IS NULL"
-                
-            if nb_wagons is not None and pd.notna(nb_wagons):
-                query += " AND nb_wagons = %s"
-                params.append(nb_wagons)
-            else:
-                query += " AND nb_wagons IS NULL"
-                
-            if is_empty is not None and pd.notna(is_empty):
-                query += " AND is_empty = %s"
-                params.append(is_empty)
-            else:
-                query += " AND is_empty IS NULL"
-            
             cursor.execute(query, tuple(params))
             db_handle.commit()
             cursor.close()
             # Ne pas fermer la connexion car elle est mise en cache
         
         # Invalider le cache des événements de simulation après modification
-        invalidate_cache()
+        invalidate_sim_events_cache(simulation_id)
         
         return True
         
@@ -889,4 +1825,103 @@ def delete_sim_event(simulation_id, modification_type, train_id=None, departure_
             db_handle.rollback()
         print(f"Erreur lors de la suppression de l'événement de simulation : {e}")
         return False
-    
+
+def apply_sim_event_changes(simulation_id, added=None, deleted=None):
+    """Applique en une seule transaction une liste d'ajouts et de suppressions d'événements de simulation.
+
+    added et deleted sont des listes de dictionnaires (ou un DataFrame) avec les clés de
+    SIM_EVENT_COLUMNS, en minuscules ou en majuscules comme dans get_sim_events. Les suppressions
+    sont regroupées en un seul DELETE et les ajouts en INSERT multi-lignes, puis le cache de la
+    simulation est invalidé une seule fois.
+    """
+    def _records(events):
+        if events is None:
+            return []
+        if isinstance(events, pd.DataFrame):
+            events = events.to_dict('records')
+        records = []
+        for event in events:
+            record = {}
+            for column in SIM_EVENT_COLUMNS:
+                value = event.get(column, event.get(column.upper()))
+                if value is None or pd.isna(value):
+                    value = None
+                elif hasattr(value, 'item'):
+                    value = value.item()  # Scalaire numpy vers type Python
+                record[column] = value
+            records.append(record)
+        return records
+
+    added = _records(added)
+    deleted = _records(deleted)
+    if not added and not deleted:
+        return True
+
+    db_handle = get_snowflake_connection_or_session()
+    is_session = isinstance(db_handle, Session)
+    placeholder = "?" if is_session else "%s"
+    statements = []
+
+    # Suppressions : une condition par événement, réunies dans un seul DELETE
+    if deleted:
+        conditions = []
+        params = [simulation_id]
+        for event in deleted:
+            condition, event_params = _sim_event_match_clause(placeholder, **event)
+            conditions.append(f"({condition})")
+            params.extend(event_params)
+        statements.append((
+            f"DELETE FROM sim_events WHERE simulation_id = {placeholder} AND ({' OR '.join(conditions)})",
+            params
+        ))
+
+    # Ajouts : INSERT multi-lignes par lots de SIM_EVENTS_BATCH_SIZE
+    row_placeholders = "(" + ", ".join([placeholder] * (len(SIM_EVENT_COLUMNS) + 1)) + ")"
+    for batch_start in range(0, len(added), SIM_EVENTS_BATCH_SIZE):
+        batch = added[batch_start:batch_start + SIM_EVENTS_BATCH_SIZE]
+        params = []
+        for event in batch:
+            params.append(simulation_id)
+            params.extend(event[column] for column in SIM_EVENT_COLUMNS)
+        statements.append((
+            f"INSERT INTO sim_events (simulation_id, {', '.join(SIM_EVENT_COLUMNS)}) VALUES "
+            + ", ".join([row_placeholders] * len(batch)),
+            params
+        ))
+
+    try:
+        if is_session:
+            # Environnement Snowflake - utiliser Snowpark
+            db_handle.sql("BEGIN").collect()
+            for query, params in statements:
+                db_handle.sql(query, params=params).collect()
+            db_handle.sql("COMMIT").collect()
+
+        else:
+            # Environnement local - utiliser snowflake.connector
+            # (connexion en autocommit : la transaction est ouverte explicitement)
+            cursor = db_handle.cursor()
+            try:
+                cursor.execute("BEGIN")
+                for query, params in statements:
+                    cursor.execute(query, tuple(params))
+                db_handle.commit()
+            finally:
+                cursor.close()
+                # Ne pas fermer la connexion car elle est mise en cache
+
+        # Une seule invalidation pour l'ensemble des modifications
+        invalidate_sim_events_cache(simulation_id)
+
+        return True
+
+    except Exception as e:
+        if is_session:
+            try:
+                db_handle.sql("ROLLBACK").collect()
+            except Exception:
+                pass
+        else:
+            db_handle.rollback()
+        print(f"Erreur lors de la mise à jour des événements de simulation : {e}")
+        return False